@@ -0,0 +1,176 @@
+"""
+Archival of soft-deleted bookings.
+
+``archive_deleted_bookings`` moves bookings that have been ``DELETED`` for
+more than ``BOOKING_ARCHIVE_AFTER_DAYS`` out of the live tables, in batches
+of ``BOOKING_ARCHIVE_BATCH_SIZE``. The bookings table has no deletion time,
+so every run records when it first saw each booking deleted, in a single
+ledger file in the archive storage. That time is at most one job period
+later than the real deletion, so nothing is archived early, and the
+request path never writes to the storage. A booking that fails to archive
+is logged and skipped; the others are still archived.
+
+The whole object graph that deleting a booking would remove (persons,
+extras, chat records, reviews and anything else cascading from it) is
+written to the archive storage as one JSON document per booking, before the
+rows are deleted. The document records the latest applied migration of
+every app in the graph. ``restore_booking`` loads the rows back with their
+original primary keys. Fields dropped by later migrations are skipped, and
+fields added since then get their defaults. If the rows still can't be
+saved, ``ArchiveSchemaMismatch`` names both schemas.
+
+Run ``archive_deleted_bookings`` from a single periodic job, e.g. daily; it
+returns the ids it archived.
+"""
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.admin.utils import NestedObjects
+from django.core import serializers
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.migrations.recorder import MigrationRecorder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from bookings.models import Booking
+
+ARCHIVE_NAME = 'booking-archive/{}.json'
+DELETED_NAME = 'booking-archive/deleted.json'
+ARCHIVE_FORMAT = 1
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveSchemaMismatch(Exception):
+    pass
+
+
+def archive_storage():
+    location = getattr(settings, 'BOOKING_ARCHIVE_ROOT', None)
+    return FileSystemStorage(location=location) if location else default_storage
+
+
+def _replace(storage, name, content):
+    if storage.exists(name):
+        storage.delete(name)
+    storage.save(name, ContentFile(content))
+
+
+def deleted_since(storage=None):
+    """
+    Return ``{booking_id: datetime}`` of when the job first saw each
+    currently deleted booking, recording the ones it sees for the first
+    time and forgetting the ones that are gone.
+    """
+    storage = storage or archive_storage()
+    known = {}
+    if storage.exists(DELETED_NAME):
+        with storage.open(DELETED_NAME) as ledger:
+            known = {int(pk): parse_datetime(since) for pk, since in json.loads(ledger.read().decode()).items()}
+    now = timezone.now()
+    deleted = {
+        booking_id: known.get(booking_id, now)
+        for booking_id in Booking.objects.filter(status=Booking.DELETED).values_list('id', flat=True)}
+    if deleted != known:
+        _replace(storage, DELETED_NAME, json.dumps(
+            {str(pk): since.isoformat() for pk, since in deleted.items()}, sort_keys=True).encode())
+    return deleted
+
+
+def archivable(storage=None):
+    """
+    Return ``{booking_id: datetime}`` of the bookings deleted longer ago than
+    the retention period.
+    """
+    threshold = timezone.now() - timedelta(days=getattr(settings, 'BOOKING_ARCHIVE_AFTER_DAYS', 90))
+    return {pk: since for pk, since in deleted_since(storage).items() if since < threshold}
+
+
+def _graph(booking):
+    collector = NestedObjects(using=DEFAULT_DB_ALIAS)
+    collector.collect([booking])
+    collector.sort()
+    # The collector orders models for deletion; parents have to be restored first.
+    objects = []
+    for model, instances in reversed(list(collector.data.items())):
+        objects.extend(sorted(instances, key=lambda instance: instance.pk))
+    return objects
+
+
+def _schema(app_labels, applied=None):
+    if applied is None:
+        applied = MigrationRecorder(connections[DEFAULT_DB_ALIAS]).applied_migrations()
+    return {
+        app_label: max(name for app, name in applied if app == app_label)
+        for app_label in app_labels if any(app == app_label for app, name in applied)}
+
+
+def archive_booking(booking, storage=None, deleted_at=None, applied=None):
+    storage = storage or archive_storage()
+    objects = _graph(booking)
+    document = {
+        'format': ARCHIVE_FORMAT,
+        'booking': booking.pk,
+        'deleted_at': deleted_at,
+        'archived_at': timezone.now(),
+        'schema': _schema({obj._meta.app_label for obj in objects}, applied),
+        'objects': serializers.serialize('python', objects),
+    }
+    name = ARCHIVE_NAME.format(booking.pk)
+    _replace(storage, name, json.dumps(document, cls=DjangoJSONEncoder).encode())
+    try:
+        booking.delete()
+    except Exception:
+        storage.delete(name)
+        raise
+
+
+def archive_deleted_bookings(batch_size=None, limit=None):
+    batch_size = batch_size or getattr(settings, 'BOOKING_ARCHIVE_BATCH_SIZE', 100)
+    storage = archive_storage()
+    due = archivable(storage)
+    ids = sorted(due)[:limit]
+    applied = MigrationRecorder(connections[DEFAULT_DB_ALIAS]).applied_migrations()
+    archived = []
+    for start in range(0, len(ids), batch_size):
+        with transaction.atomic():
+            # Skip bookings that were restored in the meantime.
+            bookings = Booking.objects.filter(
+                id__in=ids[start:start + batch_size], status=Booking.DELETED).select_for_update().order_by('id')
+            for booking in bookings:
+                try:
+                    with transaction.atomic():
+                        archive_booking(booking, storage, due[booking.pk], applied)
+                except Exception:
+                    logger.exception('Could not archive booking %s', booking.pk)
+                    continue
+                archived.append(booking.pk)
+    return archived
+
+
+def restore_booking(booking_id):
+    """
+    Put an archived booking and its related rows back and drop the archive.
+    """
+    storage = archive_storage()
+    name = ARCHIVE_NAME.format(booking_id)
+    with storage.open(name) as archive:
+        document = json.loads(archive.read().decode())
+    schema = _schema(document['schema'])
+    try:
+        with transaction.atomic():
+            for obj in serializers.deserialize('python', document['objects'], ignorenonexistent=True):
+                obj.save()
+    except (DatabaseError, DeserializationError) as error:
+        if schema == document['schema']:
+            raise
+        raise ArchiveSchemaMismatch('Booking {} was archived with {} and can not be restored into {}: {}'.format(
+            booking_id, document['schema'], schema, error))
+    storage.delete(name)
+    return Booking.objects.get(pk=booking_id)
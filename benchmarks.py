@@ -0,0 +1,163 @@
+"""
+Benchmarks for the booking API.
+
+They are not collected by the regular test run (the module name does not
+match ``test*.py``); run them explicitly::
+
+    ./manage.py test api.client.bookings.benchmarks
+
+The dataset size and iteration count come from the ``BOOKING_BENCHMARK_*``
+environment variables below. Every endpoint is measured for throughput,
+p50/p99 latency and the maximum number of SQL queries per request, and the
+results are written to ``BOOKING_BENCHMARK_RESULTS``.
+
+Budgets live in ``benchmark_baselines.json`` next to this module. Record it
+on the reference machine with ``BOOKING_BENCHMARK_UPDATE_BASELINES=1`` and
+commit it; until then the budget check is skipped. Once it exists, more
+queries than the baseline, a p99 above
+``baseline * BOOKING_BENCHMARK_TOLERANCE`` or an endpoint without a
+baseline fails the run.
+"""
+import json
+import os
+import time
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, tag
+from django.test.utils import CaptureQueriesContext
+from model_mommy import mommy
+from rest_framework.test import APIClient
+
+from common.tests import ApiStudentLoginMixin
+from bookings.models import Booking, BookingChatRecord, BookingPerson, BookingReview, BookingsExtra
+from bookings.mommy_recipes import get_booking, get_bookings
+from schools.mommy_recipes import get_acm_price_range, get_course_price_range, get_extra
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+BOOKINGS = int(os.environ.get('BOOKING_BENCHMARK_BOOKINGS', 10000))
+PERSONS = int(os.environ.get('BOOKING_BENCHMARK_PERSONS', 30))
+EXTRAS = int(os.environ.get('BOOKING_BENCHMARK_EXTRAS', 20))
+CHAT_RECORDS = int(os.environ.get('BOOKING_BENCHMARK_CHAT_RECORDS', 500))
+ITERATIONS = int(os.environ.get('BOOKING_BENCHMARK_ITERATIONS', 50))
+TOLERANCE = float(os.environ.get('BOOKING_BENCHMARK_TOLERANCE', 1.5))
+UPDATE_BASELINES = os.environ.get('BOOKING_BENCHMARK_UPDATE_BASELINES') == '1'
+RESULTS_PATH = os.environ.get('BOOKING_BENCHMARK_RESULTS', 'benchmark_results.json')
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_baselines():
+    with open(BASELINES_PATH) as baselines:
+        return json.load(baselines)
+
+
+def write_results(name, results):
+    """
+    Add ``results`` under ``name`` to the ``BOOKING_BENCHMARK_RESULTS`` file.
+    """
+    recorded = {}
+    if os.path.exists(RESULTS_PATH):
+        with open(RESULTS_PATH) as existing:
+            recorded = json.load(existing)
+    recorded[name] = results
+    with open(RESULTS_PATH, 'w') as output:
+        json.dump(recorded, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+def save_baselines(baselines):
+    with open(BASELINES_PATH, 'w') as output:
+        json.dump(baselines, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+@tag('benchmark')
+class BookingApiBenchmark(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        get_bookings(BOOKINGS - 1, user=self.user)
+        self.booking = get_booking(user=self.user)
+        self.booking.created_by = self.user
+        self.booking.save()
+        get_course_price_range(course=self.booking.course, unit_price=100, weeks_count_from=2, weeks_count_to=32)
+        get_acm_price_range(accommodation=self.booking.accommodation, unit_price=50,
+                            weeks_count_from=2, weeks_count_to=32)
+        mommy.make(BookingPerson, booking=self.booking, _quantity=PERSONS)
+        for _ in range(EXTRAS):
+            mommy.make(BookingsExtra, booking=self.booking, extra=get_extra(), price=10)
+        mommy.make(BookingChatRecord, booking=self.booking, _quantity=CHAT_RECORDS)
+        mommy.make(BookingReview, booking=self.booking, _quantity=10)
+
+    def measure(self, request):
+        timings = []
+        queries = 0
+        for iteration in range(ITERATIONS):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = request(iteration)
+                timings.append(time.perf_counter() - started)
+            self.assertLess(response.status_code, 300)
+            queries = max(queries, len(captured))
+        return {
+            'queries': queries,
+            'p50_ms': round(percentile(timings, 50) * 1000, 2),
+            'p99_ms': round(percentile(timings, 99) * 1000, 2),
+            'requests_per_second': round(len(timings) / sum(timings), 1),
+        }
+
+    def full_payload(self, iteration):
+        """
+        The booking as the client app sends it on save: every field with all
+        persons and extras, of which only ``callback`` changes.
+        """
+        if not hasattr(self, '_payload'):
+            detail = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+            self._payload = self.client.get(detail).json()
+        return dict(self._payload, callback=bool(iteration % 2))
+
+    def endpoints(self):
+        detail = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        chat = reverse('api-client:bookings-chat', kwargs={'pk': self.booking.id})
+        review = reverse('api-client:bookings-review', kwargs={'pk': self.booking.id})
+        my = reverse('api-client:bookings-my')
+        return [
+            ('my', lambda iteration: self.client.get(my)),
+            ('retrieve', lambda iteration: self.client.get(detail)),
+            ('patch', lambda iteration: self.client.patch(detail, {'callback': bool(iteration % 2)}, format='json')),
+            ('update', lambda iteration: self.client.put(detail, self.full_payload(iteration), format='json')),
+            ('chat', lambda iteration: self.client.get(chat)),
+            ('review', lambda iteration: self.client.get(review)),
+        ]
+
+    def test_budgets(self):
+        results = {name: self.measure(request) for name, request in self.endpoints()}
+        write_results('booking_api', {'bookings': Booking.objects.count(), 'endpoints': results})
+        if UPDATE_BASELINES:
+            save_baselines({
+                name: {'queries': result['queries'], 'p99_ms': result['p99_ms']}
+                for name, result in results.items()})
+            return
+
+        if not os.path.exists(BASELINES_PATH):
+            self.skipTest('No {} recorded; run with BOOKING_BENCHMARK_UPDATE_BASELINES=1 and commit it.'.format(
+                os.path.basename(BASELINES_PATH)))
+        baselines = load_baselines()
+        failures = []
+        for name, result in sorted(results.items()):
+            baseline = baselines.get(name)
+            if baseline is None:
+                failures.append('{}: no baseline in {}'.format(name, os.path.basename(BASELINES_PATH)))
+                continue
+            if result['queries'] > baseline['queries']:
+                failures.append('{}: {} queries, budget {}'.format(name, result['queries'], baseline['queries']))
+            if result['p99_ms'] > baseline['p99_ms'] * TOLERANCE:
+                failures.append('{}: p99 {}ms, budget {}ms'.format(
+                    name, result['p99_ms'], round(baseline['p99_ms'] * TOLERANCE, 2)))
+        self.assertFalse(failures, '\n'.join(failures))
@@ -0,0 +1,138 @@
+"""
+Bulk booking actions.
+
+One query resolves which of the requested bookings the user may touch and
+every id gets its own result in the response. Deleting and marking as
+viewed is one ``UPDATE``; status changes go through ``BookingSerializer``
+and the concurrency check of the update view booking by booking, so they
+get the same validation, e-mails and conflict handling. The whole action
+runs in one transaction.
+"""
+from django.db import transaction
+from rest_framework import serializers
+
+from bookings.models import Booking
+from .concurrency import Conflict, lock_if_unchanged, row_image
+from .counters import not_viewed_counter
+from .notifications import BookingNotifications
+from .serializers import BookingSerializer
+from .versions import bump_booking_versions
+
+OK = 'ok'
+NOT_FOUND = 'not_found'
+NOT_ALLOWED = 'not_allowed'
+CONFLICT = 'conflict'
+
+# Statuses in which the client may still change a booking.
+EDITABLE_STATUSES = (Booking.NEW, Booking.WAITING_SCHOOL, Booking.WAITING_UPDATE)
+# Target status -> statuses a booking may be submitted from.
+STATUS_TRANSITIONS = {
+    Booking.WAITING_SCHOOL: (Booking.NEW, Booking.WAITING_UPDATE),
+}
+
+
+class BookingBulkActionSerializer(serializers.Serializer):
+    DELETE = 'delete'
+    MARK_VIEWED = 'mark_viewed'
+    STATUS = 'status'
+
+    ids = serializers.ListField(child=serializers.IntegerField(), min_length=1, max_length=500)
+    operation = serializers.ChoiceField(choices=(DELETE, MARK_VIEWED, STATUS))
+    status = serializers.ChoiceField(choices=list(STATUS_TRANSITIONS), required=False)
+
+    def validate(self, attrs):
+        if attrs['operation'] == self.STATUS and 'status' not in attrs:
+            raise serializers.ValidationError({'status': 'This field is required for the status operation.'})
+        return attrs
+
+
+class BulkBookingAction(object):
+    def __init__(self, user, ids, operation, status=None, context=None):
+        self.user = user
+        self.ids = list(dict.fromkeys(ids))
+        self.operation = operation
+        self.status = status
+        self.context = context or {}
+
+    def allowed_from(self):
+        if self.operation == BookingBulkActionSerializer.STATUS:
+            return STATUS_TRANSITIONS[self.status]
+        if self.operation == BookingBulkActionSerializer.DELETE:
+            return EDITABLE_STATUSES
+        return None
+
+    def values(self):
+        if self.operation == BookingBulkActionSerializer.MARK_VIEWED:
+            return {'viewed': True}
+        if self.operation == BookingBulkActionSerializer.DELETE:
+            return {'status': Booking.DELETED}
+        return {'status': self.status}
+
+    @transaction.atomic
+    def run(self):
+        rows = {
+            row[0]: row for row in Booking.objects.my_frontend(self.user).filter(id__in=self.ids).values_list(
+                'id', 'status', 'user_id', 'created_by_id')}
+        allowed_from = self.allowed_from()
+        results = {}
+        eligible = []
+        for booking_id in self.ids:
+            if booking_id not in rows:
+                results[booking_id] = NOT_FOUND
+            elif allowed_from is not None and rows[booking_id][1] not in allowed_from:
+                results[booking_id] = NOT_ALLOWED
+            elif self.operation == BookingBulkActionSerializer.STATUS and not rows[booking_id][3]:
+                # Status mails go to the client who created the booking.
+                results[booking_id] = NOT_ALLOWED
+            else:
+                eligible.append(booking_id)
+
+        if self.operation == BookingBulkActionSerializer.STATUS:
+            self.transition(eligible, allowed_from, results)
+        else:
+            self.update(eligible, allowed_from, results, rows)
+        return [{'id': booking_id, 'result': results[booking_id]} for booking_id in self.ids]
+
+    def update(self, eligible, allowed_from, results, rows):
+        queryset = Booking.objects.filter(id__in=eligible)
+        if allowed_from is not None:
+            queryset = queryset.filter(status__in=allowed_from)
+        updated = queryset.update(**self.values()) if eligible else 0
+        if updated != len(eligible):
+            # Some bookings changed status between the two queries.
+            current = dict(Booking.objects.filter(id__in=eligible).values_list('id', 'status'))
+            target = self.values().get('status')
+            for booking_id in eligible:
+                if booking_id not in current or (target is not None and current[booking_id] != target):
+                    results[booking_id] = CONFLICT
+        done = [booking_id for booking_id in eligible if booking_id not in results]
+        for booking_id in done:
+            results[booking_id] = OK
+
+        bump_booking_versions(*done)
+        not_viewed_counter.invalidate_on_commit(*[user_id for booking_id in done for user_id in rows[booking_id][2:]])
+
+    def transition(self, eligible, allowed_from, results):
+        for notifications in BookingNotifications.load_many(eligible):
+            booking = notifications.booking
+            old_status = booking.status
+            if old_status not in allowed_from:
+                results[booking.id] = CONFLICT
+                continue
+            image = row_image(booking)
+            serializer = BookingSerializer(booking, data={'status': self.status}, partial=True, context=self.context)
+            if not serializer.is_valid():
+                results[booking.id] = NOT_ALLOWED
+                continue
+            try:
+                with transaction.atomic():
+                    lock_if_unchanged(image)
+                    serializer.save()
+            except Conflict:
+                results[booking.id] = CONFLICT
+                continue
+            results[booking.id] = OK
+            notifications.send(old_status == Booking.NEW and self.status == Booking.WAITING_SCHOOL, ['status'])
+        for booking_id in eligible:
+            # Deleted between the two queries.
+            results.setdefault(booking_id, CONFLICT)
@@ -0,0 +1,155 @@
+"""
+Diff of a validated booking payload against the stored booking.
+
+``BookingChanges`` tells ``BookingViewSet.update`` which columns really
+change, whether prices have to be recomputed and whether the payload can
+skip the serializer save altogether. Nested rows are diffed as well, so a
+full PUT that only edits a person's contact details writes just those
+columns.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router
+from django.db.models.fields.files import FieldFile
+from django.db.models.signals import post_save, pre_save
+
+from .concurrency import Conflict
+from .nested import MATCH_KEYS, PRICED_SETS
+from .versions import bump_booking_versions
+
+PRICING_FIELDS = ('course', 'accommodation', 'weeks_count', 'start_at', 'person_count', 'user_location')
+NESTED_FIELDS = ('persons', 'bookingsextra_set')
+# Status transitions are applied by the serializer save, even when the value is unchanged.
+SERIALIZER_FIELDS = ('status', )
+_UNKNOWN = object()
+
+
+def _pk(value):
+    return getattr(value, 'pk', value)
+
+
+def _file_url(obj, name):
+    """
+    The stored value of a ``<file field>_url`` key such as
+    ``passport_image_url``; a sentinel for any other key.
+    """
+    file = getattr(obj, name[:-len('_url')], None) if name.endswith('_url') else None
+    if not isinstance(file, FieldFile):
+        return _UNKNOWN
+    return file.url if file else None
+
+
+class BookingChanges(object):
+    def __init__(self, instance, validated_data):
+        self.instance = instance
+        self.submitted = set(validated_data)
+        self.fields = {}
+        self.unknown = []
+        for name, value in validated_data.items():
+            if name in NESTED_FIELDS:
+                continue
+            try:
+                field = instance._meta.get_field(name)
+            except FieldDoesNotExist:
+                self.unknown.append(name)
+                continue
+            if field.is_relation:
+                if getattr(instance, field.attname) != _pk(value):
+                    self.fields[name] = value
+            elif getattr(instance, name) != value:
+                self.fields[name] = value
+        # {name: {pk: {column: value}}}, or None for a set that can't be updated row by row.
+        self.rows = {name: self._nested_rows(name, validated_data[name])
+                     for name in NESTED_FIELDS if name in validated_data}
+        self.nested = [name for name in NESTED_FIELDS if name in self.rows and self.rows[name] != {}]
+        self.pricing = self._pricing_changed(validated_data)
+
+    def _nested_rows(self, name, items):
+        """
+        Match submitted nested rows with the stored ones, by their key or
+        else by position, and return the columns each of them changes.
+        """
+        stored = list(getattr(self.instance, name).all())
+        if len(items) != len(stored):
+            return None
+        key = MATCH_KEYS[name]
+        by_key = {getattr(obj, obj._meta.get_field(key).attname): obj for obj in stored}
+        rows = {}
+        for position, item in enumerate(items):
+            if key == 'id':
+                obj = by_key.get(_pk(item['id'])) if item.get('id') else stored[position]
+            else:
+                # Extras are only identified by their extra; an item without one is a replacement.
+                obj = by_key.get(_pk(item.get(key)))
+            if obj is None:
+                return None
+            changed = {}
+            for field_name, value in item.items():
+                if field_name == 'id':
+                    continue
+                try:
+                    field = obj._meta.get_field(field_name)
+                except FieldDoesNotExist:
+                    if _file_url(obj, field_name) != value:
+                        return None
+                    continue
+                if not field.concrete:
+                    return None
+                if getattr(obj, field.attname) != (_pk(value) if field.is_relation else value):
+                    changed[field_name] = value
+            if changed:
+                rows[obj.pk] = changed
+        return rows
+
+    def _pricing_changed(self, validated_data):
+        if any(name in self.fields for name in PRICING_FIELDS):
+            return True
+        if any(self.rows.get(name) for name in PRICED_SETS):
+            return True
+        persons = validated_data.get('persons')
+        if persons is not None and len(persons) != self.instance.person_count:
+            return True
+        extras = validated_data.get('bookingsextra_set')
+        if extras is not None:
+            if any('extra' not in extra for extra in extras):
+                return True
+            stored = sorted(self.instance.bookingsextra_set.values_list('extra_id', flat=True))
+            return sorted(_pk(extra['extra']) for extra in extras) != stored
+        return False
+
+    @property
+    def column_only(self):
+        """
+        True when the payload only changes plain columns, which can be
+        written without going through the serializer save.
+        """
+        return bool(
+            not self.pricing and not self.unknown and self.instance.created_by_id and
+            all(rows is not None for rows in self.rows.values()) and
+            not any(name in self.submitted for name in SERIALIZER_FIELDS))
+
+    def apply(self, image):
+        """
+        Write the changed columns with a single UPDATE that only matches
+        the row as it was read (see ``concurrency.row_image``); a concurrent
+        write makes it match nothing and raises ``Conflict``. The save
+        signals are sent as ``save(update_fields=...)`` would.
+        """
+        for name, value in self.fields.items():
+            setattr(self.instance, name, value)
+        if self.fields:
+            model = type(self.instance)
+            update_fields = frozenset(self.fields)
+            using = router.db_for_write(model, instance=self.instance)
+            pre_save.send(sender=model, instance=self.instance, raw=False, using=using, update_fields=update_fields)
+            values = {model._meta.get_field(name).attname: _pk(value) for name, value in self.fields.items()}
+            if not model._base_manager.using(using).filter(**image).update(**values):
+                raise Conflict()
+            post_save.send(sender=model, instance=self.instance, created=False, raw=False, using=using,
+                           update_fields=update_fields)
+        for name, rows in self.rows.items():
+            model = getattr(self.instance, name).model
+            for pk, changed in rows.items():
+                model.objects.filter(pk=pk).update(**changed)
+        if self.nested:
+            bump_booking_versions(self.instance.id)
+        return self.instance
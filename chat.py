@@ -0,0 +1,82 @@
+"""
+Incremental booking chat sync.
+
+Clients pass ``after`` (the last record id or ISO timestamp they have) to
+receive only newer records, and ``wait`` to long-poll: the request is held
+until a record is committed or the timeout expires. While waiting only a
+cache marker, bumped once a ``BookingChatRecord`` save commits, is polled,
+so idle chats cost no queries.
+
+A waiting request still occupies a worker of the (synchronous) application
+server for up to ``BOOKING_CHAT_MAX_WAIT`` seconds, so that limit is kept
+short by default; size the worker pool for the number of open chats before
+raising it.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from bookings.models import BookingChatRecord
+from .routers import read_from_replica
+
+CACHE_KEY = 'bookings:chat:{}'
+
+
+def chat_marker(booking_id):
+    return cache.get(CACHE_KEY.format(booking_id))
+
+
+@receiver(post_save, sender=BookingChatRecord)
+def bump_chat_marker(sender, instance, **kwargs):
+    # Waiters re-query when the marker changes, so the record has to be visible by then.
+    key = CACHE_KEY.format(instance.booking_id)
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, None))
+
+
+def records_after(queryset, after):
+    if after.isdigit():
+        return queryset.filter(id__gt=int(after))
+    try:
+        created_at = parse_datetime(after)
+    except ValueError:
+        created_at = None
+    if created_at is None:
+        raise ValidationError({'after': 'Expected a chat record id or an ISO 8601 timestamp.'})
+    return queryset.filter(created_at__gt=created_at)
+
+
+def parse_wait(value):
+    try:
+        wait = float(value)
+    except ValueError:
+        raise ValidationError({'wait': 'Expected a number of seconds.'})
+    return max(0.0, min(wait, getattr(settings, 'BOOKING_CHAT_MAX_WAIT', 5.0)))
+
+
+def wait_for_records(queryset, booking_id, timeout):
+    """
+    Evaluate ``queryset`` until it returns records or ``timeout`` seconds
+    pass. The queryset is only re-run after the chat marker changes, and
+    always on the primary: the marker changes when the record commits
+    there, a replica may not have it yet.
+    """
+    interval = getattr(settings, 'BOOKING_CHAT_POLL_INTERVAL', 0.25)
+    deadline = time.monotonic() + timeout
+    while True:
+        marker = chat_marker(booking_id)
+        with read_from_replica(None):
+            records = list(queryset.all())
+        if records:
+            return records
+        while chat_marker(booking_id) == marker:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return records
+            time.sleep(min(interval, remaining))
@@ -0,0 +1,67 @@
+"""
+Concurrency checks for booking updates.
+
+Clients send the booking's ETag in ``If-Match``; a stale one is rejected
+with 412 before anything is written. Only the booking token is compared,
+which covers the booking row, its persons and extras, so chat messages,
+reviews and price changes don't fail the next autosave.
+
+The bookings table has no version column, so the server-side check
+compares the whole row instead: ``row_image`` records the booking as the
+update read it. A column-only update writes with an ``UPDATE`` filtered on
+that image (``BookingChanges.apply``), so the check costs no extra query.
+Saves that go through the serializer call ``lock_if_unchanged`` first,
+which locks the row only if it still matches. Either way a write that
+committed in the meantime makes it match no row and the request ends with
+409. No lock is held while the payload is validated.
+"""
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from bookings.models import Booking
+from .versions import booking_etag
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The booking has been changed since it was read.'
+    default_code = 'precondition_failed'
+
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The booking was changed by a concurrent update.'
+    default_code = 'conflict'
+
+
+def check_if_match(request, booking_id):
+    header = request.META.get('HTTP_IF_MATCH')
+    if not header:
+        return
+    etags = parse_etags(header)
+    # Detail ETags append pricing tokens to the booking one; only that part has to be current.
+    current = booking_etag(booking_id)[:-1]
+    if '*' not in etags and not any(etag[:-1] == current or etag.startswith(current + '-') for etag in etags):
+        raise PreconditionFailed()
+
+
+def row_image(booking):
+    """
+    Lookups matching the loaded columns of ``booking`` as they are now.
+    """
+    image = {'pk': booking.pk}
+    for field in booking._meta.concrete_fields:
+        if field.primary_key or field.attname not in booking.__dict__:
+            continue
+        value = booking.__dict__[field.attname]
+        if value is None:
+            image['{}__isnull'.format(field.attname)] = True
+        else:
+            image[field.attname] = value
+    return image
+
+
+def lock_if_unchanged(image):
+    if not Booking.objects.select_for_update().filter(**image).exists():
+        raise Conflict()
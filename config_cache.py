@@ -0,0 +1,89 @@
+"""
+Process-local cache in front of constance.
+
+``local_config.mget`` returns constance values from memory and only goes to
+the constance backend, with a single ``mget``, for keys it has not seen yet.
+Every ``BOOKING_CONFIG_TTL`` seconds the shared version key is checked;
+admins changing a value replace that key, which empties the local caches of
+all processes. Without constance's change signal nothing replaces the key,
+so the local values are then simply dropped every ``BOOKING_CONFIG_TTL``
+seconds.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from constance import config
+
+try:
+    from constance.signals import config_updated
+except ImportError:  # constance < 2.0 has no change signal
+    config_updated = None
+
+VERSION_KEY = 'bookings:constance-version'
+
+
+class LocalConfig(object):
+
+    def __init__(self):
+        self._values = {}
+        self._version = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'BOOKING_CONFIG_TTL', 30)
+
+    def mget(self, keys):
+        self._refresh()
+        values = self._values
+        missing = [key for key in keys if key not in values]
+        if missing:
+            with self._lock:
+                values = dict(self._values, **self._load(missing))
+                self._values = values
+        return {key: values[key] for key in keys}
+
+    def get(self, key):
+        return self.mget([key])[key]
+
+    def clear(self):
+        self._values = {}
+        self._expires_at = 0
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now < self._expires_at:
+            return
+        version = cache.get(VERSION_KEY)
+        if config_updated is None or version != self._version:
+            self._values = {}
+            self._version = version
+        self._expires_at = now + self.ttl
+
+    def _load(self, keys):
+        backend = getattr(config, '_backend', None)
+        values = {}
+        if hasattr(backend, 'mget'):
+            values = {key: value for key, value in backend.mget(keys) if value is not None}
+        for key in keys:
+            if key not in values:
+                # Not stored yet: constance falls back to the default.
+                values[key] = getattr(config, key)
+        return values
+
+
+local_config = LocalConfig()
+
+
+def invalidate_local_config(**kwargs):
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    local_config.clear()
+
+
+if config_updated is not None:
+    config_updated.connect(invalidate_local_config, dispatch_uid='bookings-local-config')
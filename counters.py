@@ -0,0 +1,119 @@
+"""
+Per-user counter of not viewed bookings.
+
+The value is kept in the cache so polling ``my_not_viewed_count`` does not
+touch the bookings table; a missing or outdated entry falls back to a COUNT
+over ``Booking.objects.my_not_viewed``. Saves that change ``viewed`` or
+``status`` replace the generation token of the booking's user and creator
+once they commit; entries are stored with the generation read before
+counting, so a count that raced with such a save is never served.
+
+Entries expire after ``BOOKING_NOT_VIEWED_COUNTER_TIMEOUT``, which bounds how
+long a counter that drifted because of bulk updates can stay wrong;
+``reconcile`` repairs them right away and is meant for the jobs doing such
+updates.
+"""
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from bookings.models import Booking
+from .routers import read_from_replica
+
+CACHE_KEY = 'bookings:not-viewed:{}'
+GENERATION_KEY = 'bookings:not-viewed-generation:{}'
+
+
+class NotViewedCounter(object):
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'BOOKING_NOT_VIEWED_COUNTER_TIMEOUT', 60 * 15)
+
+    def key(self, user_id):
+        return CACHE_KEY.format(user_id)
+
+    def generation_key(self, user_id):
+        return GENERATION_KEY.format(user_id)
+
+    def get(self, user):
+        key, generation_key = self.key(user.id), self.generation_key(user.id)
+        cached = cache.get_many([key, generation_key])
+        generation = cached.get(generation_key) or self._new_generation(user.id)
+        entry = cached.get(key)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        value = self.count(user)
+        cache.set(key, (generation, value), self.timeout)
+        return value
+
+    def count(self, user):
+        # The result is shared through the cache, so never count on a lagging replica.
+        with read_from_replica(None):
+            return Booking.objects.my_not_viewed(user).count()
+
+    def reset(self, user):
+        generation = cache.get(self.generation_key(user.id)) or self._new_generation(user.id)
+        cache.set(self.key(user.id), (generation, 0), self.timeout)
+
+    def invalidate(self, *user_ids):
+        cache.set_many({self.generation_key(user_id): uuid.uuid4().hex for user_id in set(user_ids) if user_id}, None)
+
+    def invalidate_on_commit(self, *user_ids):
+        transaction.on_commit(lambda: self.invalidate(*user_ids))
+
+    def reconcile(self, users=None):
+        """
+        Recount the cached counters of ``users`` (every user owning a booking
+        by default) and return how many of them had drifted.
+        """
+        if users is None:
+            users = get_user_model().objects.filter(
+                id__in=Booking.objects.values_list('user_id', flat=True).distinct())
+        repaired = 0
+        for user in users:
+            entry = cache.get(self.key(user.id))
+            if entry is None:
+                continue
+            generation = cache.get(self.generation_key(user.id)) or self._new_generation(user.id)
+            value = self.count(user)
+            if entry != (generation, value):
+                cache.set(self.key(user.id), (generation, value), self.timeout)
+                repaired += 1
+        return repaired
+
+    def _new_generation(self, user_id):
+        generation_key = self.generation_key(user_id)
+        cache.add(generation_key, uuid.uuid4().hex, None)
+        return cache.get(generation_key)
+
+
+not_viewed_counter = NotViewedCounter()
+
+
+def _counted_state(instance):
+    # Read from __dict__ so deferred fields are never loaded just for this.
+    return instance.__dict__.get('viewed'), instance.__dict__.get('status')
+
+
+@receiver(post_init, sender=Booking)
+def remember_counted_state(sender, instance, **kwargs):
+    instance._not_viewed_state = _counted_state(instance)
+
+
+@receiver(post_save, sender=Booking)
+def invalidate_on_save(sender, instance, created, **kwargs):
+    state = _counted_state(instance)
+    if created or state != getattr(instance, '_not_viewed_state', None):
+        not_viewed_counter.invalidate_on_commit(instance.user_id, instance.created_by_id)
+    instance._not_viewed_state = state
+
+
+@receiver(post_delete, sender=Booking)
+def invalidate_on_delete(sender, instance, **kwargs):
+    not_viewed_counter.invalidate_on_commit(instance.user_id, instance.created_by_id)
@@ -0,0 +1,67 @@
+"""
+Cache of serialized ``BookingSerializer`` payloads.
+
+Entries are keyed by the booking's version token and the pricing tokens of
+its course and accommodation (see ``versions``), so any save that changes
+the payload makes the old entry unreachable. Those tokens are replaced
+again once a save commits, so a payload built from the old rows while the
+save was in flight ends up under a key that is never read again; ``warm``
+must likewise only be called after the commit. Only one worker rebuilds a
+missing entry; the others wait for it instead of serializing in parallel.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .versions import detail_versions
+
+CACHE_KEY = 'bookings:detail:{}:{}:{}:{}'
+LOCK_KEY = 'bookings:detail-lock:{}'
+
+
+class BookingDetailCache(object):
+
+    @property
+    def timeout(self):
+        # Payloads also contain currency conversions, so keep them short lived.
+        return getattr(settings, 'BOOKING_DETAIL_CACHE_TIMEOUT', 60 * 5)
+
+    @property
+    def lock_timeout(self):
+        return getattr(settings, 'BOOKING_DETAIL_CACHE_LOCK_TIMEOUT', 5)
+
+    def key(self, booking):
+        return CACHE_KEY.format(booking.id, *detail_versions(booking))
+
+    def get_or_build(self, booking, build):
+        key = self.key(booking)
+        data = cache.get(key)
+        if data is not None:
+            return data
+        lock = LOCK_KEY.format(key)
+        if not cache.add(lock, 1, self.lock_timeout):
+            data = self._wait(key)
+            if data is not None:
+                return data
+        try:
+            data = build()
+            cache.set(key, data, self.timeout)
+        finally:
+            cache.delete(lock)
+        return data
+
+    def warm(self, booking, data):
+        cache.set(self.key(booking), data, self.timeout)
+
+    def _wait(self, key):
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            data = cache.get(key)
+            if data is not None:
+                return data
+        return None
+
+
+booking_detail_cache = BookingDetailCache()
@@ -0,0 +1,59 @@
+"""
+Streaming export of a user's bookings.
+
+Bookings are read in keyset chunks of ``BOOKING_EXPORT_CHUNK_SIZE`` ids, so
+memory stays flat and the first rows go out before the rest is read. Each
+chunk is built with ``compiled_list_rows``: one query for the rows and one
+for their extras.
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .fieldsets import LIST_EXTRAS, compiled_list_rows
+
+EXPORT_FIELDS = (
+    'id', 'status', 'start_at', 'weeks_count', 'person_count', 'school_id', 'school_name', 'course_name',
+    'accommodation_name', LIST_EXTRAS)
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def booking_chunks(queryset):
+    chunk_size = getattr(settings, 'BOOKING_EXPORT_CHUNK_SIZE', 500)
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield compiled_list_rows(queryset, ids, EXPORT_FIELDS)
+        last_id = ids[-1]
+
+
+def ndjson_lines(queryset):
+    for rows in booking_chunks(queryset):
+        yield ''.join(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows)
+
+
+class _Line(object):
+    def write(self, value):
+        return value
+
+
+def csv_lines(queryset):
+    writer = csv.writer(_Line())
+    yield writer.writerow(EXPORT_FIELDS)
+    for rows in booking_chunks(queryset):
+        yield ''.join(writer.writerow(
+            ['; '.join(name or '' for name in row[field]) if field == LIST_EXTRAS else row[field]
+             for field in EXPORT_FIELDS]) for row in rows)
+
+
+EXPORTERS = {
+    'ndjson': ndjson_lines,
+    'csv': csv_lines,
+}
@@ -0,0 +1,95 @@
+"""
+Sparse fieldsets for booking responses.
+
+``?fields=id,status`` limits a response to the listed fields and
+``?expand=school`` adds nested serializers on top of them; fields that were
+not asked for are dropped from the serializer before it runs, so their
+method fields and nested serializers are never evaluated. Without
+``fields`` responses are complete.
+
+Booking list pages that only ask for plain fields are built straight from
+``values()`` rows by ``compiled_list_rows`` without instantiating models or
+serializers.
+"""
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+from bookings.models import BookingsExtra
+
+# BookingListSerializer field -> values() lookup.
+LIST_VALUES = {
+    'id': 'id',
+    'status': 'status',
+    'weeks_count': 'weeks_count',
+    'start_at': 'start_at',
+    'person_count': 'person_count',
+    'school_id': 'course__school_id',
+    'school_name': 'course__school__name',
+    'course_name': 'course__type__name',
+    'accommodation_name': 'accommodation__type__name',
+}
+LIST_DATES = ('start_at', )
+LIST_EXTRAS = 'extras_names'
+
+
+def requested(request, param):
+    value = request.query_params.get(param)
+    if not value:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def requested_fields(request):
+    """
+    The ``fields`` of ``request`` together with its ``expand``; None for a
+    complete response.
+    """
+    fields = requested(request, 'fields')
+    if fields is None:
+        return None
+    return fields | (requested(request, 'expand') or set())
+
+
+def apply_fieldsets(serializer, request):
+    fields = requested_fields(request)
+    if fields is None:
+        return serializer
+    target = getattr(serializer, 'child', serializer)
+    unknown = fields - set(target.fields)
+    if unknown:
+        raise ValidationError({'fields': 'Unknown fields: {}.'.format(', '.join(sorted(unknown)))})
+    for name in list(target.fields):
+        if name not in fields:
+            target.fields.pop(name)
+    return serializer
+
+
+def compilable(fields):
+    return fields is not None and all(name in LIST_VALUES or name == LIST_EXTRAS for name in fields)
+
+
+def compiled_list_rows(queryset, booking_ids, fields):
+    """
+    Build list items for ``booking_ids`` from ``values()`` rows, in the
+    order of ``booking_ids``.
+    """
+    columns = [name for name in fields if name in LIST_VALUES]
+    rows = queryset.filter(id__in=booking_ids).values('id', *[LIST_VALUES[name] for name in columns])
+    date_field = serializers.DateField()
+    items = {}
+    for row in rows:
+        item = {}
+        for name in columns:
+            value = row[LIST_VALUES[name]]
+            if name in LIST_DATES and value is not None:
+                value = date_field.to_representation(value)
+            item[name] = value
+        items[row['id']] = item
+    if LIST_EXTRAS in fields:
+        for item in items.values():
+            item[LIST_EXTRAS] = []
+        extras = BookingsExtra.objects.filter(booking_id__in=booking_ids).order_by('id').values_list(
+            'booking_id', 'extra__name')
+        for booking_id, name in extras:
+            items[booking_id][LIST_EXTRAS].append(name)
+    return [items[booking_id] for booking_id in booking_ids if booking_id in items]
@@ -0,0 +1,171 @@
+"""
+Timing and counters for ``BookingViewSet`` actions.
+
+A sampled request (``BOOKING_METRICS_SAMPLE_RATE``) gets an
+``ActionMetrics`` that records phase spans (``get_object``, ``validate``,
+``save``, ``serialize``, ``email``...), the number and time of its SQL
+queries on every database alias and the response payload size. When the response has been
+rendered the record is handed to every sink in ``BOOKING_METRICS_SINKS``:
+
+* ``LoggingSink`` writes one structured log line,
+* ``RegistrySink`` feeds the Prometheus-style ``registry``,
+* ``ServerTimingSink`` adds a ``Server-Timing`` header.
+
+Requests that are not sampled get ``NULL_METRICS``, whose spans do nothing.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class NullMetrics(object):
+    sampled = False
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def finish(self, response):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class ActionMetrics(object):
+    sampled = True
+
+    def __init__(self, action, method, sinks):
+        self.action = action
+        self.method = method
+        self.sinks = sinks
+        self.phases = OrderedDict()
+        self.counters = {}
+        self.started = time.perf_counter()
+        # Reads routed to a replica run on another alias than ``default``.
+        self._connections = connections.all()
+        self._debug_cursors = [conn.force_debug_cursor for conn in self._connections]
+        self._first_queries = [len(conn.queries_log) for conn in self._connections]
+        for conn in self._connections:
+            conn.force_debug_cursor = True
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def finish(self, response):
+        duration = time.perf_counter() - self.started
+        queries = []
+        for conn, debug_cursor, first_query in zip(self._connections, self._debug_cursors, self._first_queries):
+            conn.force_debug_cursor = debug_cursor
+            queries.extend(list(conn.queries_log)[first_query:])
+        self.counters['sql_count'] = len(queries)
+        self.counters['sql_ms'] = round(sum(float(query['time']) for query in queries) * 1000, 3)
+        self.phases['total'] = duration
+
+        def emit(response):
+            if not getattr(response, 'streaming', False):
+                self.counters['payload_bytes'] = len(response.content)
+            for sink in self.sinks:
+                try:
+                    sink.emit(self, response)
+                except Exception:
+                    logger.exception('Metrics sink %r failed', sink)
+            return response
+
+        if hasattr(response, 'add_post_render_callback') and not response.is_rendered:
+            response.add_post_render_callback(emit)
+        else:
+            emit(response)
+
+    def as_dict(self):
+        return {
+            'action': self.action,
+            'method': self.method,
+            'phases_ms': {name: round(value * 1000, 3) for name, value in self.phases.items()},
+            'counters': self.counters,
+        }
+
+
+def start_metrics(action, method):
+    rate = getattr(settings, 'BOOKING_METRICS_SAMPLE_RATE', 0.0)
+    if not rate or random.random() >= rate:
+        return NULL_METRICS
+    return ActionMetrics(action, method, sinks())
+
+
+_sinks = {}
+
+
+def sinks():
+    paths = tuple(getattr(settings, 'BOOKING_METRICS_SINKS', ('api.client.bookings.instrumentation.LoggingSink', )))
+    if paths not in _sinks:
+        _sinks[paths] = [import_string(path)() for path in paths]
+    return _sinks[paths]
+
+
+class LoggingSink(object):
+    def emit(self, metrics, response):
+        logger.info('booking_api %s', json.dumps(dict(metrics.as_dict(), status=response.status_code)))
+
+
+class ServerTimingSink(object):
+    def emit(self, metrics, response):
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.3f}'.format(name, value * 1000) for name, value in metrics.phases.items())
+
+
+class Registry(object):
+    """
+    Minimal in-process metrics registry rendered in the Prometheus text
+    format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        self.inc('{}_count'.format(name), labels)
+        self.inc('{}_sum'.format(name), labels, value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            items = sorted(self._counters.items())
+        for (name, labels), value in items:
+            label_text = ','.join('{}="{}"'.format(key, label) for key, label in labels)
+            lines.append('{}{{{}}} {}'.format(name, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class RegistrySink(object):
+    def emit(self, metrics, response):
+        labels = {'action': metrics.action, 'method': metrics.method}
+        registry.inc('booking_api_requests_total', dict(labels, status=response.status_code))
+        for name, value in metrics.phases.items():
+            registry.observe('booking_api_phase_seconds', dict(labels, phase=name), value)
+        for name, value in metrics.counters.items():
+            registry.observe('booking_api_{}'.format(name), labels, value)
@@ -0,0 +1,110 @@
+"""
+Diff-based PATCH of the nested booking sets.
+
+A PATCH may carry partial items for ``persons`` and ``bookingsextra_set``.
+Rows are identified the way the API exposes them: persons by their ``id``,
+extras by their ``extra``. An item naming a stored row updates only the
+fields it contains, any other item is created, and ``persons_removed`` /
+``bookingsextra_set_removed`` list the person ids / extras to delete. Only
+the touched rows are written: creates go through one ``bulk_create``,
+deletes through one ``DELETE`` and every changed row gets a single
+``UPDATE`` of its changed columns.
+"""
+from rest_framework.exceptions import ValidationError
+
+NESTED_SETS = ('persons', 'bookingsextra_set')
+# Every column of an extra row feeds the booking total; persons only count.
+PRICED_SETS = ('bookingsextra_set', )
+# The field identifying a stored row of each set; the extras' ``id`` is not their primary key.
+MATCH_KEYS = {'persons': 'id', 'bookingsextra_set': 'extra'}
+
+
+class NestedPatch(object):
+    def __init__(self, booking, name, items, removed, child):
+        self.booking = booking
+        self.name = name
+        self.items = items or []
+        self.removed = removed or []
+        self.child = child
+        self.manager = getattr(booking, name)
+        self.model = self.manager.model
+        self.fk_name = self.manager.field.name
+        self.columns = {field.name for field in self.model._meta.concrete_fields}
+        self.key = MATCH_KEYS[name]
+        self.attname = self.model._meta.get_field(self.key).attname
+        self.created = []
+        self.updated = {}
+        self.deleted = 0
+
+    @classmethod
+    def from_data(cls, booking, data, serializer):
+        """
+        Pop the nested PATCH entries out of ``data`` and return a patch for
+        every nested set they mention.
+        """
+        patches = []
+        for name in NESTED_SETS:
+            removed_key = '{}_removed'.format(name)
+            if name not in data and removed_key not in data:
+                continue
+            child = serializer.fields[name].child
+            patches.append(cls(booking, name, data.pop(name, None), data.pop(removed_key, None), child))
+        return patches
+
+    def _validate(self, item, partial):
+        serializer = type(self.child)(data=item, partial=partial, context=self.child.context)
+        serializer.is_valid(raise_exception=True)
+        values = dict(serializer.validated_data)
+        values.pop('id', None)
+        unknown = [key for key in values if key not in self.columns]
+        if unknown:
+            raise ValidationError({self.name: 'Fields {} can only be changed with PUT.'.format(', '.join(unknown))})
+        return values
+
+    def apply(self):
+        stored = {getattr(obj, self.attname): obj for obj in self.manager.all()}
+        missing = [value for value in self.removed if value not in stored]
+        if self.key == 'id':
+            missing += [item['id'] for item in self.items if item.get('id') and item['id'] not in stored]
+        if missing:
+            raise ValidationError({self.name: 'Unknown {}s: {}.'.format(
+                self.key, ', '.join(str(value) for value in missing))})
+
+        for item in self.items:
+            if item.get(self.key) not in stored:
+                values = self._validate(item, partial=False)
+                values[self.fk_name] = self.booking
+                self.created.append(self.model(**values))
+                continue
+            obj = stored[item[self.key]]
+            values = self._validate(item, partial=True)
+            changed = {}
+            for name, value in values.items():
+                field = self.model._meta.get_field(name)
+                current = getattr(obj, field.attname)
+                if current != (getattr(value, 'pk', value) if field.is_relation else value):
+                    changed[name] = value
+            if changed:
+                self.updated[obj.pk] = changed
+
+        if self.removed:
+            self.deleted, _ = self.manager.filter(**{'{}__in'.format(self.attname): self.removed}).delete()
+        if self.created:
+            self.model.objects.bulk_create(self.created)
+        for pk, changed in self.updated.items():
+            self.model.objects.filter(id=pk).update(**changed)
+        return self
+
+    @property
+    def changed(self):
+        return bool(self.created or self.updated or self.deleted)
+
+    @property
+    def count_changed(self):
+        return bool(self.created or self.deleted)
+
+    @property
+    def pricing_changed(self):
+        if self.name in PRICED_SETS:
+            return self.changed
+        return self.count_changed
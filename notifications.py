@@ -0,0 +1,430 @@
+"""
+Booking notification e-mails.
+
+``BookingNotifications`` loads the booking graph once and builds every
+message of one update from that snapshot. Mails are never sent on the
+request path: they are written to the durable ``outbox`` once the
+surrounding transaction commits and sent from there by worker threads and
+a periodic ``outbox.drain()`` job, in batches, retrying failed deliveries
+with exponential backoff.
+
+"Booking updated" mails go through ``update_debouncer``: updates of one
+booking for the same recipient within ``BOOKING_UPDATE_NOTIFICATION_WINDOW``
+seconds are merged into a single mail listing every changed field.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+
+from bookings.models import Booking
+from common.utils import send_email
+from .config_cache import local_config
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_KEY = 'bookings:notification-debounce:{}:{}:{}'
+DEBOUNCE_LOCK_KEY = '{}:lock'
+
+
+class OutboxMessage(object):
+    kind = 'mail'
+
+    def __init__(self, subject, to, template, ctx, id=None, attempts=0):
+        self.id = id or uuid.uuid4().hex
+        self.subject = subject
+        self.to = to
+        self.template = template
+        self.ctx = ctx
+        self.attempts = attempts
+
+    def __repr__(self):
+        return '<OutboxMessage {} to {}>'.format(self.template, self.to)
+
+    def prepare(self):
+        """
+        Called by the worker right before sending; False means there is
+        nothing to send any more.
+        """
+        return True
+
+    def as_dict(self):
+        return {
+            'kind': self.kind, 'id': self.id, 'subject': self.subject, 'to': self.to,
+            'template': self.template, 'ctx': self.ctx, 'attempts': self.attempts,
+        }
+
+    @staticmethod
+    def from_dict(data):
+        data = dict(data)
+        return MESSAGE_KINDS[data.pop('kind')](**data)
+
+
+class CoalescedMessage(OutboxMessage):
+    """
+    Mail that claims the debounce entry ``key`` right before it is sent, so
+    it carries every update merged into it. It is written with the first
+    update's subject and context, which are sent as they are when the entry
+    is gone from the cache.
+    """
+    kind = 'coalesced'
+
+    def __init__(self, key, to, template, subject=None, ctx=None, **kwargs):
+        super(CoalescedMessage, self).__init__(subject, to, template, ctx, **kwargs)
+        self.key = key
+
+    def prepare(self):
+        if self.key is None:
+            return True
+        with debounce_lock(self.key):
+            entry = cache.get(self.key)
+            if entry is not None and entry['message'] == self.id:
+                cache.delete(self.key)
+                self.subject = entry['subject']
+                self.ctx = dict(entry['ctx'], changes=entry['changes'])
+        # Claimed: a retry sends what was claimed instead of looking again.
+        self.key = None
+        return True
+
+    def as_dict(self):
+        return dict(super(CoalescedMessage, self).as_dict(), key=self.key)
+
+
+MESSAGE_KINDS = {OutboxMessage.kind: OutboxMessage, CoalescedMessage.kind: CoalescedMessage}
+
+
+class EmailOutbox(object):
+    """
+    Durable outbox for booking e-mails, kept as one JSON file per message in
+    ``BOOKING_EMAIL_OUTBOX_DIR``. The setting is required: outside eager
+    mode and tests, putting mail without it raises ``ImproperlyConfigured``.
+
+    ``put`` writes the message when the surrounding transaction commits, so
+    rolled back bookings never produce mail, and written mail survives worker
+    recycling and deploys. ``drain`` claims due messages with an atomic
+    rename, so each one is sent by a single worker, and reschedules failures
+    with exponential backoff. Messages that still fail after
+    ``BOOKING_EMAIL_OUTBOX_MAX_ATTEMPTS`` are moved to ``dead/`` and logged.
+
+    ``drain`` runs in a few worker threads of every process that puts mail
+    and should also be run by a periodic job, which picks up what a recycled
+    process left behind. With ``BOOKING_EMAIL_OUTBOX_EAGER`` enabled messages
+    are delivered synchronously on commit, which is handy for tests and
+    management commands.
+    """
+
+    def __init__(self):
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    @property
+    def root(self):
+        # Has to be a persistent directory shared by the processes draining it.
+        root = getattr(settings, 'BOOKING_EMAIL_OUTBOX_DIR', None)
+        if root:
+            return root
+        # The test runner installs mail.outbox; nothing there has to outlive the process.
+        if getattr(settings, 'BOOKING_EMAIL_OUTBOX_EAGER', False) or hasattr(mail, 'outbox'):
+            return os.path.join(tempfile.gettempdir(), 'booking-email-outbox')
+        raise ImproperlyConfigured(
+            'BOOKING_EMAIL_OUTBOX_DIR has to be set to a persistent directory; queued mail would be lost '
+            'with a temporary one.')
+
+    @property
+    def workers(self):
+        return getattr(settings, 'BOOKING_EMAIL_OUTBOX_WORKERS', 2)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'BOOKING_EMAIL_OUTBOX_BATCH_SIZE', 20)
+
+    @property
+    def max_attempts(self):
+        return getattr(settings, 'BOOKING_EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+
+    @property
+    def backoff(self):
+        return getattr(settings, 'BOOKING_EMAIL_OUTBOX_BACKOFF', 2.0)
+
+    @property
+    def poll_interval(self):
+        return getattr(settings, 'BOOKING_EMAIL_OUTBOX_POLL_INTERVAL', 5.0)
+
+    @property
+    def claim_timeout(self):
+        # A claim older than this belongs to a worker that died while sending.
+        return getattr(settings, 'BOOKING_EMAIL_OUTBOX_CLAIM_TIMEOUT', 60 * 5)
+
+    def put(self, subject, to, template, ctx):
+        self.root  # Fails before the commit rather than losing the mail after it.
+        message = OutboxMessage(subject, to, template, ctx)
+        transaction.on_commit(lambda: self.enqueue(message))
+        return message
+
+    def enqueue(self, message, delay=0):
+        self._write('ready', message, time.time() + delay)
+        if getattr(settings, 'BOOKING_EMAIL_OUTBOX_EAGER', False):
+            if not delay:
+                self.drain()
+            return
+        self._wake()
+
+    def pending(self, state='ready'):
+        """
+        Return the messages in ``state`` (ready, claimed or dead).
+        """
+        return [self._read(state, name) for name in self._names(state)]
+
+    def drain(self):
+        """
+        Deliver every due message and return how many were handled.
+        """
+        self._release_stale_claims()
+        handled = 0
+        while True:
+            batch = self._claim()
+            if not batch:
+                return handled
+            self.deliver(batch)
+            handled += len(batch)
+
+    def deliver(self, batch):
+        """
+        Send every message of ``batch`` and return the ones that failed but
+        may still be retried; those are written back with their backoff and
+        the ones given up on go to ``dead/`` before their claim is released.
+        """
+        retry = []
+        for message in batch:
+            try:
+                if not message.prepare():
+                    continue
+                message.attempts += 1
+                try:
+                    send_email(message.subject, message.to, message.template, message.ctx)
+                except Exception:
+                    if message.attempts >= self.max_attempts:
+                        logger.exception('Giving up on %r after %d attempts', message, message.attempts)
+                        self._write('dead', message, time.time())
+                    else:
+                        logger.warning('Failed to send %r, attempt %d', message, message.attempts, exc_info=True)
+                        self._write('ready', message, time.time() + self.backoff ** message.attempts)
+                        retry.append(message)
+            finally:
+                self._remove('claimed', getattr(message, 'spool_name', None))
+        return retry
+
+    def _path(self, state, name=''):
+        return os.path.join(self.root, state, name)
+
+    def _names(self, state):
+        try:
+            return sorted(name for name in os.listdir(self._path(state)) if name.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def _write(self, state, message, due):
+        # The due time leads the name, so sorted names are in sending order.
+        name = '{:017.6f}-{}.json'.format(due, message.id)
+        for directory in ('tmp', state):
+            os.makedirs(self._path(directory), exist_ok=True)
+        tmp = self._path('tmp', name)
+        with open(tmp, 'w') as output:
+            json.dump(message.as_dict(), output, cls=DjangoJSONEncoder)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(tmp, self._path(state, name))
+
+    def _read(self, state, name):
+        with open(self._path(state, name)) as spooled:
+            message = OutboxMessage.from_dict(json.load(spooled))
+        message.spool_name = name
+        return message
+
+    def _remove(self, state, name):
+        if name:
+            try:
+                os.remove(self._path(state, name))
+            except FileNotFoundError:
+                pass
+
+    def _claim(self):
+        os.makedirs(self._path('claimed'), exist_ok=True)
+        now = time.time()
+        batch = []
+        for name in self._names('ready'):
+            if len(batch) >= self.batch_size or float(name.split('-', 1)[0]) > now:
+                break
+            try:
+                # Only one worker wins the rename.
+                os.rename(self._path('ready', name), self._path('claimed', name))
+            except FileNotFoundError:
+                continue
+            os.utime(self._path('claimed', name))
+            batch.append(self._read('claimed', name))
+        return batch
+
+    def _release_stale_claims(self):
+        stale = time.time() - self.claim_timeout
+        for name in self._names('claimed'):
+            try:
+                if os.path.getmtime(self._path('claimed', name)) < stale:
+                    os.rename(self._path('claimed', name), self._path('ready', name))
+            except FileNotFoundError:
+                pass
+
+    def _wake(self):
+        self._ensure_workers()
+        self._wakeup.set()
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='booking-email-outbox')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Draining the booking e-mail outbox failed')
+            finally:
+                close_old_connections()
+
+
+outbox = EmailOutbox()
+
+
+class UpdateDebouncer(object):
+    """
+    Merges "booking updated" mails into the pending ``CoalescedMessage`` of
+    the same booking and recipient.
+
+    The message is written to the outbox with a delay of ``window`` seconds
+    when the first update commits, so sending it does not depend on the
+    process staying up. Later updates only merge into the cache entry, which
+    never outlives the message's due time by more than one window: a
+    steady stream of updates still produces one mail per window.
+    """
+
+    @property
+    def window(self):
+        return getattr(settings, 'BOOKING_UPDATE_NOTIFICATION_WINDOW', 60 * 5)
+
+    def put(self, subject, to, template, ctx, changes):
+        changes = sorted(set(changes))
+        if not self.window:
+            return outbox.put(subject, to, template, dict(ctx, changes=changes))
+        key = DEBOUNCE_KEY.format(ctx['booking_id'], to, template)
+        outbox.root  # Fails before the commit rather than losing the mail after it.
+        transaction.on_commit(lambda: self.merge(key, subject, to, template, ctx, changes))
+
+    def merge(self, key, subject, to, template, ctx, changes):
+        now = time.time()
+        with debounce_lock(key):
+            entry = cache.get(key)
+            if entry is not None:
+                # The pending mail gets the latest context and all changes so far.
+                changes = sorted(set(entry['changes']) | set(changes))
+            if entry is None or entry['due'] + self.window <= now:
+                # No pending mail, or its worker never claimed it: schedule a new one.
+                message = CoalescedMessage(key, to, template, subject, dict(ctx, changes=changes))
+                entry = {'message': message.id, 'due': now + self.window}
+                outbox.enqueue(message, delay=self.window)
+            entry.update(subject=subject, ctx=ctx, changes=changes)
+            cache.set(key, entry, max(1, int(entry['due'] + self.window - now)))
+
+
+@contextmanager
+def debounce_lock(key):
+    """
+    Serialize merging into and claiming of the debounce entry ``key``.
+    """
+    lock = DEBOUNCE_LOCK_KEY.format(key)
+    timeout = getattr(settings, 'BOOKING_UPDATE_NOTIFICATION_LOCK_TIMEOUT', 5)
+    deadline = time.monotonic() + timeout
+    # The lock expires with its timeout, so a crashed holder blocks others for that long at most.
+    acquired = cache.add(lock, 1, timeout)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.01)
+        acquired = cache.add(lock, 1, timeout)
+    try:
+        yield
+    finally:
+        if acquired:
+            cache.delete(lock)
+
+
+update_debouncer = UpdateDebouncer()
+
+
+class BookingNotifications(object):
+    """
+    Notification e-mails of one booking, built from a single query.
+
+    ``created`` selects the NEW -> WAITING_SCHOOL messages (confirmation for
+    the client and "booking created" for the school owner); otherwise the
+    school owner gets a single "booking updated" mail.
+    """
+    related = ('course__school', 'course__type', 'created_by', 'user', 'school__created_by')
+
+    def __init__(self, booking):
+        self.booking = booking
+
+    @classmethod
+    def load(cls, booking_id):
+        return cls(Booking.objects.select_related(*cls.related).get(id=booking_id))
+
+    @classmethod
+    def load_many(cls, booking_ids):
+        return [cls(booking) for booking in Booking.objects.select_related(*cls.related).filter(id__in=booking_ids)]
+
+    def course_ctx(self):
+        booking = self.booking
+        return dict(school=booking.course.school.name, course=booking.course.type.name)
+
+    def client_ctx(self):
+        client = self.booking.created_by
+        return dict(
+            self.course_ctx(),
+            user_first_name=client.first_name, user_last_name=client.last_name, user_email=client.email)
+
+    def messages(self, created):
+        booking = self.booking
+        if created:
+            subjects = local_config.mget(['EMAIL_BOOKING_CREATE_CLIENT_CONFIRM', 'EMAIL_BOOKING_CREATE_USER'])
+            return [
+                (subjects['EMAIL_BOOKING_CREATE_CLIENT_CONFIRM'], booking.created_by.email, 'booking_confirm',
+                 self.course_ctx()),
+                (subjects['EMAIL_BOOKING_CREATE_USER'], booking.school.created_by.email, 'booking_created',
+                 self.client_ctx()),
+            ]
+        return [
+            (local_config.get('EMAIL_BOOKING_UPDATE_USER'), booking.school.created_by.email, 'booking_updated',
+             dict(self.client_ctx(), booking_id=booking.id)),
+        ]
+
+    def send(self, created, changes=()):
+        for subject, to, template, ctx in self.messages(created):
+            if template == 'booking_updated':
+                update_debouncer.put(subject, to, template, ctx, changes)
+            else:
+                outbox.put(subject, to, template, ctx)
@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class BookingCursorPagination(CursorPagination):
+    """
+    Keyset pagination for booking lists: pages cost the same however many
+    bookings the user has.
+    """
+    ordering = ('-created_at', 'id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -0,0 +1,65 @@
+"""
+Memoised course and accommodation quotes.
+
+``Course.course_price`` and ``Accommodation.acm_price`` query the price
+ranges on every call. ``pricing_engine`` keeps their results in the cache,
+keyed by the item's pricing token (see ``versions``), the quote date, the
+number of weeks and the user location, so repeated quotes are lookups and
+any change to the item or its price ranges starts a fresh set of entries.
+
+``bind`` points the ``course_price``/``acm_price`` methods of given course
+and accommodation instances at the engine; the booking views bind the items
+a create or update saves, so the serializer's price calculation is memoised
+without knowing about the engine.
+"""
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+
+from schools.models import Accommodation, Course
+from .versions import pricing_versions
+
+CACHE_KEY = 'bookings:quote:{}:{}:{}:{}:{}:{}'
+
+
+def _day(value):
+    # Price ranges are defined per day, so datetimes share a quote with their date.
+    return value.date().isoformat() if hasattr(value, 'date') else value.isoformat()
+
+
+class PricingEngine(object):
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'BOOKING_QUOTE_CACHE_TIMEOUT', 60 * 60)
+
+    def course_price(self, course, created_at, weeks_count, user_location):
+        # Called through the class so a bound instance does not call back into the engine.
+        return self._quote(
+            'course', course.id, created_at, weeks_count, user_location,
+            lambda: Course.course_price(course, created_at, weeks_count, user_location))
+
+    def acm_price(self, accommodation, start_at, weeks_count):
+        return self._quote(
+            'accommodation', accommodation.id, start_at, weeks_count, None,
+            lambda: Accommodation.acm_price(accommodation, start_at, weeks_count))
+
+    def bind(self, *items):
+        for item in items:
+            if isinstance(item, Course):
+                item.course_price = partial(self.course_price, item)
+            elif isinstance(item, Accommodation):
+                item.acm_price = partial(self.acm_price, item)
+
+    def _quote(self, kind, item_id, day, weeks_count, user_location, calculate):
+        version, = pricing_versions([(kind, item_id)])
+        key = CACHE_KEY.format(kind, item_id, version, _day(day), weeks_count, user_location)
+        quote = cache.get(key)
+        if quote is None:
+            quote = calculate()
+            cache.set(key, quote, self.timeout)
+        return quote
+
+
+pricing_engine = PricingEngine()
@@ -0,0 +1,85 @@
+"""
+Read-replica routing for the read-only booking endpoints.
+
+Enable it by adding ``api.client.bookings.routers.BookingReplicaRouter`` to
+``DATABASE_ROUTERS`` and listing replica aliases in
+``BOOKING_READ_REPLICAS``. ``BookingViewSet`` then runs its read actions
+inside ``read_from_replica``; users who have just written are pinned to the
+primary for ``BOOKING_PRIMARY_PIN_SECONDS`` so they always read their own
+writes.
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_KEY = 'bookings:primary-pin:{}'
+
+_state = threading.local()
+
+
+def replicas():
+    return list(getattr(settings, 'BOOKING_READ_REPLICAS', []))
+
+
+def pin_to_primary(user):
+    if user.is_authenticated:
+        cache.set(PIN_KEY.format(user.id), True, getattr(settings, 'BOOKING_PRIMARY_PIN_SECONDS', 10))
+
+
+def is_pinned_to_primary(user):
+    return user.is_authenticated and bool(cache.get(PIN_KEY.format(user.id)))
+
+
+def replica_for(user):
+    """
+    Return the alias ``user`` should read from, or None for the primary.
+    """
+    aliases = replicas()
+    if not aliases or is_pinned_to_primary(user):
+        return None
+    return random.choice(aliases)
+
+
+def current_replica():
+    return getattr(_state, 'alias', None)
+
+
+def start_reading_from(alias):
+    _state.alias = alias
+
+
+def stop_reading_from_replica():
+    _state.alias = None
+
+
+@contextmanager
+def read_from_replica(alias):
+    previous = current_replica()
+    start_reading_from(alias)
+    try:
+        yield
+    finally:
+        start_reading_from(previous)
+
+
+class BookingReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return current_replica()
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set([DEFAULT_DB_ALIAS] + replicas())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
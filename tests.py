@@ -1,11 +1,20 @@
 from constance.test import override_config
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import DatabaseError, connection, transaction
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from model_mommy import mommy
 from rest_framework.test import APIClient
 from django.utils.timezone import now
 import json
+import tempfile
+from datetime import timedelta
+from unittest import mock
 from core.models import UploadedFile
 from django.core.files.base import ContentFile
 from django.core.files import File
@@ -14,14 +23,46 @@ from common.tests import ApiStudentLoginMixin, ApiProviderManagerLoginMixin, get
 from core.models import Language, Country, Currency, City
 from core.mommy_recipes import get_city, get_language
 from accounts.mommy_recipes import get_student
-from bookings.models import Booking, BookingPerson, BookingsExtra, BookingPerson
+from bookings.models import Booking, BookingPerson, BookingsExtra, BookingPerson, BookingChatRecord, BookingReview
 from schools.models import Course, Accommodation, Extra
 from bookings.mommy_recipes import get_booking, get_bookings, _next_monday, get_booking_extra
-from api.client.bookings.serializers import BookingSerializer, BookingsExtraSerializer
+from api.client.bookings.serializers import BookingSerializer, BookingsExtraSerializer, BookingReviewSerializer
+from api.client.bookings.archive import archive_deleted_bookings, archive_storage, deleted_since, restore_booking
+from api.client.bookings.changes import BookingChanges
+from api.client.bookings.chat import chat_marker, wait_for_records
+from api.client.bookings.concurrency import Conflict, lock_if_unchanged, row_image
+from api.client.bookings.config_cache import invalidate_local_config, local_config
+from api.client.bookings.counters import not_viewed_counter
+from api.client.bookings.detail_cache import booking_detail_cache
+from api.client.bookings.export import EXPORT_FIELDS
+from api.client.bookings.instrumentation import NULL_METRICS, ActionMetrics, registry, start_metrics
+from api.client.bookings.nested import NestedPatch
+from api.client.bookings.notifications import outbox, EmailOutbox, OutboxMessage, BookingNotifications, \
+    CoalescedMessage, update_debouncer
+from api.client.bookings.pricing import pricing_engine
+from api.client.bookings.routers import BookingReplicaRouter, current_replica, read_from_replica, replica_for
+from api.client.bookings.uploads import upload_token
+from api.client.bookings.versions import booking_etag
 from schools.mommy_recipes import get_school, get_accommodation, get_course, get_extra, get_course_type, \
     get_accommodation_type, get_school_extra, get_course_price_range, get_acm_price_range
 
 
+class OnCommitMixin:
+    def run_on_commit(self):
+        """
+        TestCase never commits: run on_commit callbacks right away, with the
+        mails they produce sent eagerly to a mocked send_email.
+        """
+        outbox_settings = override_settings(BOOKING_EMAIL_OUTBOX_DIR=tempfile.mkdtemp(),
+                                            BOOKING_EMAIL_OUTBOX_EAGER=True)
+        outbox_settings.enable()
+        self.addCleanup(outbox_settings.disable)
+        for patcher in (mock.patch.object(transaction, 'on_commit', side_effect=lambda func, using=None: func()),
+                        mock.patch('api.client.bookings.notifications.send_email')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
 # LIST
 class ListTestCaseMixin:
     def setUp(self):
@@ -37,7 +78,7 @@ class ListTestCaseMixin:
         url = reverse('api-client:bookings-my')
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 3)
+        self.assertEqual(len(response.json()['results']), 3)
 
         today = now().date()
         booking = Booking.objects.get(pk=bookings[0].pk)
@@ -58,7 +99,7 @@ class ListTestCaseMixin:
                 expected_data['extras_names'].append(extra.extra.name)
 
         self.assertDictEqual(
-            [x for x in response.json() if x.get('id') == booking.pk][0], expected_data)
+            [x for x in response.json()['results'] if x.get('id') == booking.pk][0], expected_data)
 
 
 class NonAuthListTestCase(TestCase):
@@ -89,7 +130,28 @@ class StudentListTestCase(ApiStudentLoginMixin, ListTestCaseMixin, TestCase):
         # Check booking was deleted
         response = self.client.get(list_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 2)
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_list_query_count(self):
+        url = reverse('api-client:bookings-my')
+        get_bookings(2, user=self.user)
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        get_bookings(6, user=self.user)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()['results']), 8)
+        self.assertEqual(len(many), len(few))
+
+    def test_list_pagination(self):
+        bookings = get_bookings(3, user=self.user)
+        url = reverse('api-client:bookings-my')
+        response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(len(response.json()['results']), 2)
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertIsNone(response.json()['next'])
+        self.assertIn(response.json()['results'][0]['id'], [booking.id for booking in bookings])
 
 
 class ProviderListTestCase(ApiProviderManagerLoginMixin, ListTestCaseMixin, TestCase):
@@ -404,6 +466,103 @@ class StudentUpdateTestCase(ApiStudentLoginMixin, UpdateTestCaseMixin, TestCase)
         response = self.client.put(url2, self.updated_data)
         self.assertEqual(response.status_code, 403)
 
+    def test_column_only_patch(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        with mock.patch.object(BookingSerializer, 'save', side_effect=AssertionError):
+            response = self.client.patch(url, {'callback': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        updated_booking = Booking.objects.get(pk=self.booking.id)
+        self.assertTrue(updated_booking.callback)
+        self.assertEqual(updated_booking.total_price, self.booking.total_price)
+
+    def test_pricing_changes(self):
+        changes = BookingChanges(self.booking, {'callback': True, 'weeks_count': self.booking.weeks_count})
+        self.assertEqual(changes.fields, {'callback': True})
+        self.assertFalse(changes.pricing)
+        self.assertTrue(BookingChanges(self.booking, {'weeks_count': self.booking.weeks_count + 1}).pricing)
+        self.assertTrue(BookingChanges(self.booking, {'course': self.booking2.course}).pricing)
+        persons = [{}] * (self.booking.person_count + 1)
+        changes = BookingChanges(self.booking, {'persons': persons})
+        self.assertTrue(changes.pricing)
+        self.assertFalse(changes.column_only)
+        self.assertFalse(BookingChanges(self.booking, {'persons': [{}] * self.booking.person_count}).pricing)
+
+    def test_unchanged_nested_sets_are_not_reported(self):
+        persons = [{'id': person.id, 'phone': person.phone} for person in self.booking.persons.all()]
+        self.assertEqual(BookingChanges(self.booking, {'persons': persons}).nested, [])
+        persons[0]['phone'] = '+100'
+        self.assertEqual(BookingChanges(self.booking, {'persons': persons}).nested, ['persons'])
+
+    def test_put_with_changed_person_phone(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        data = self.client.get(url).json()
+        data['persons'][0]['phone'] = '+100'
+        total_price = Booking.objects.get(pk=self.booking.id).total_price
+        with mock.patch.object(BookingSerializer, 'save', side_effect=AssertionError), \
+                mock.patch.object(pricing_engine, 'bind', side_effect=AssertionError):
+            response = self.client.put(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.booking.persons.get(pk=data['persons'][0]['id']).phone, '+100')
+        self.assertEqual(Booking.objects.get(pk=self.booking.id).total_price, total_price)
+
+    def test_unchanged_status_goes_through_serializer(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        changes = BookingChanges(self.booking, {'status': self.booking.status})
+        self.assertEqual(changes.fields, {})
+        self.assertFalse(changes.column_only)
+
+    def test_patch_persons(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        person = self.booking.persons.first()
+        with mock.patch.object(BookingSerializer, 'save', side_effect=AssertionError):
+            response = self.client.patch(url, {'persons': [{'id': person.id, 'phone': '+100'}]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(BookingPerson.objects.get(pk=person.id).phone, '+100')
+
+        response = self.client.patch(url, {'persons': [{'gender': 'F', 'order': 1}]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        updated_booking = Booking.objects.get(pk=self.booking.id)
+        self.assertEqual(updated_booking.persons.count(), 2)
+        self.assertEqual(updated_booking.person_count, 2)
+
+        added = updated_booking.persons.exclude(id=person.id).get()
+        response = self.client.patch(url, {'persons_removed': [added.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        updated_booking = Booking.objects.get(pk=self.booking.id)
+        self.assertEqual(updated_booking.person_count, 1)
+        self.assertEqual(updated_booking.total_price, self.booking.total_price)
+
+        response = self.client.patch(url, {'persons_removed': [self.booking2.persons.first().id]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_patch_extras(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        kept = mommy.make(BookingsExtra, booking=self.booking, extra=get_extra(), price=10)
+        removed = mommy.make(BookingsExtra, booking=self.booking, extra=get_extra(), price=20)
+        response = self.client.patch(url, {'bookingsextra_set_removed': [-1]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.patch(url, {'bookingsextra_set': [{'extra': kept.extra_id}],
+                                           'bookingsextra_set_removed': [removed.extra_id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(self.booking.bookingsextra_set.values_list('id', flat=True)), [kept.id])
+
+    def test_patched_extra_reprices(self):
+        extras = NestedPatch(self.booking, 'bookingsextra_set', [], [], None)
+        extras.updated = {1: {'price': 5}}
+        self.assertTrue(extras.pricing_changed)
+        persons = NestedPatch(self.booking, 'persons', [], [], None)
+        persons.updated = {1: {'phone': '+100'}}
+        self.assertFalse(persons.pricing_changed)
+
     def test_status(self):
         url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
         self.updated_data['status'] = Booking.NEW
@@ -437,3 +596,927 @@ class StudentUpdateTestCase(ApiStudentLoginMixin, UpdateTestCaseMixin, TestCase)
         updated_booking.save()
         response = self.client.put(url, self.updated_data, format='json')
         self.assertEqual(response.status_code, 403)
+
+
+# NOTIFICATIONS
+class EmailOutboxTestCase(TestCase):
+    def setUp(self):
+        self.settings = override_settings(BOOKING_EMAIL_OUTBOX_DIR=tempfile.mkdtemp())
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def test_put_waits_for_commit(self):
+        user = get_student()
+        user.save()
+        booking = get_booking(user=user)
+        with mock.patch('api.client.bookings.notifications.send_email') as send_email, \
+                mock.patch.object(transaction, 'on_commit') as on_commit:
+            outbox.put('subject', 'school@example.com', 'booking_updated', {'booking_id': booking.id})
+            self.assertEqual(on_commit.call_count, 1)
+            self.assertFalse(send_email.called)
+        self.assertEqual(outbox.pending(), [])
+
+    def test_survives_restart(self):
+        with mock.patch.object(outbox, '_wake'):
+            outbox.enqueue(OutboxMessage('subject', 'school@example.com', 'booking_updated', {'booking_id': 1}))
+            outbox.enqueue(OutboxMessage('later', 'school@example.com', 'booking_updated', {}), delay=60)
+        restarted = EmailOutbox()
+        with mock.patch('api.client.bookings.notifications.send_email') as send_email:
+            self.assertEqual(restarted.drain(), 1)
+        send_email.assert_called_once_with('subject', 'school@example.com', 'booking_updated', {'booking_id': 1})
+        self.assertEqual([message.subject for message in restarted.pending()], ['later'])
+        self.assertEqual(restarted.pending('claimed'), [])
+
+    @override_settings(BOOKING_EMAIL_OUTBOX_EAGER=False)
+    def test_put_requires_outbox_dir(self):
+        del settings.BOOKING_EMAIL_OUTBOX_DIR
+        # Outside tests there is no mail.outbox.
+        with mock.patch('api.client.bookings.notifications.mail', spec=[]), \
+                mock.patch.object(transaction, 'on_commit') as on_commit:
+            with self.assertRaises(ImproperlyConfigured):
+                outbox.put('subject', 'school@example.com', 'booking_updated', {})
+        self.assertFalse(on_commit.called)
+
+    @override_settings(BOOKING_EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_deliver_retries(self):
+        message = OutboxMessage('subject', 'school@example.com', 'booking_updated', {})
+        with mock.patch('api.client.bookings.notifications.send_email',
+                        side_effect=[Exception('relay down'), Exception('relay down')]) as send_email:
+            self.assertEqual(outbox.deliver([message]), [message])
+            self.assertEqual(outbox.pending()[0].attempts, 1)
+            self.assertEqual(outbox.deliver([message]), [])
+            self.assertEqual(send_email.call_count, 2)
+        self.assertEqual(message.attempts, 2)
+        self.assertEqual([dead.id for dead in outbox.pending('dead')], [message.id])
+
+
+class BookingNotificationsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_student()
+        self.user.save()
+        self.booking = get_booking(user=self.user)
+        self.booking.created_by = self.user
+        self.booking.save()
+
+    def tearDown(self):
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def assertMessagesQueries(self, created, templates):
+        with mock.patch('api.client.bookings.notifications.local_config'), self.assertNumQueries(1):
+            messages = BookingNotifications.load(self.booking.id).messages(created)
+        self.assertEqual([template for _, _, template, _ in messages], templates)
+        return messages
+
+    def test_new_to_waiting_school(self):
+        messages = self.assertMessagesQueries(True, ['booking_confirm', 'booking_created'])
+        self.assertEqual(messages[0][1], self.user.email)
+        self.assertEqual(messages[1][3]['user_email'], self.user.email)
+
+    def test_update(self):
+        messages = self.assertMessagesQueries(False, ['booking_updated'])
+        self.assertEqual(messages[0][3]['booking_id'], self.booking.id)
+
+
+# NOT VIEWED COUNTER
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class NotViewedCounterTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.bookings = get_bookings(3, user=self.user)
+        Booking.objects.filter(id__in=[booking.id for booking in self.bookings]).update(viewed=False)
+        self.url = reverse('api-client:bookings-my-not-viewed-count')
+
+    def tearDown(self):
+        cache.clear()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_poll_is_cached(self):
+        expected = Booking.objects.my_not_viewed(self.user).count()
+        self.assertEqual(self.client.get(self.url).json()['not_viewed_count'], expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(not_viewed_counter.get(self.user), expected)
+
+    def test_set_viewed(self):
+        self.client.get(self.url)
+        self.client.post(reverse('api-client:bookings-my-set-viewed'))
+        with self.assertNumQueries(0):
+            self.assertEqual(not_viewed_counter.get(self.user), 0)
+
+    def test_save_invalidates_on_commit(self):
+        self.client.get(self.url)
+        booking = Booking.objects.get(pk=self.bookings[0].pk)
+        booking.viewed = True
+        with mock.patch.object(transaction, 'on_commit') as on_commit:
+            booking.save()
+        with self.assertNumQueries(0):
+            not_viewed_counter.get(self.user)
+        on_commit.call_args[0][0]()
+        self.assertEqual(self.client.get(self.url).json()['not_viewed_count'],
+                         Booking.objects.my_not_viewed(self.user).count())
+
+    def test_count_racing_with_save_is_not_served(self):
+        def count_and_invalidate(user):
+            value = Booking.objects.my_not_viewed(user).count()
+            not_viewed_counter.invalidate(user.id)
+            return value
+
+        with mock.patch.object(not_viewed_counter, 'count', side_effect=count_and_invalidate):
+            not_viewed_counter.get(self.user)
+        with self.assertNumQueries(1):
+            not_viewed_counter.get(self.user)
+
+    def test_reconcile(self):
+        self.client.get(self.url)
+        generation = cache.get(not_viewed_counter.generation_key(self.user.id))
+        cache.set(not_viewed_counter.key(self.user.id), (generation, 100))
+        self.assertEqual(not_viewed_counter.reconcile([self.user]), 1)
+        self.assertEqual(not_viewed_counter.get(self.user), Booking.objects.my_not_viewed(self.user).count())
+
+
+# CHAT
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ChatSyncTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+        self.records = mommy.make(BookingChatRecord, booking=self.booking, _quantity=3)
+        self.url = reverse('api-client:bookings-chat', kwargs={'pk': self.booking.id})
+
+    def tearDown(self):
+        cache.clear()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_after(self):
+        response = self.client.get(self.url, {'after': self.records[0].id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        response = self.client.get(self.url, {'after': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_wait_times_out_without_new_records(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                wait_for_records(BookingChatRecord.objects.none(), self.booking.id, 0.1), [])
+
+    def test_commit_bumps_marker(self):
+        marker = chat_marker(self.booking.id)
+        with mock.patch.object(transaction, 'on_commit') as on_commit:
+            mommy.make(BookingChatRecord, booking=self.booking)
+        self.assertEqual(chat_marker(self.booking.id), marker)
+        on_commit.call_args[0][0]()
+        self.assertNotEqual(chat_marker(self.booking.id), marker)
+        response = self.client.get(self.url, {'after': self.records[-1].id, 'wait': 1})
+        self.assertEqual(len(response.json()), 1)
+
+
+# CONDITIONAL GET
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalGetTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+
+    def tearDown(self):
+        cache.clear()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_retrieve(self):
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        person = self.booking.persons.first()
+        person.first_name = 'Changed'
+        person.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_version_replaced_again_on_commit(self):
+        etag = booking_etag(self.booking.id)
+        with mock.patch.object(transaction, 'on_commit') as on_commit:
+            self.booking.persons.first().save()
+        pending = booking_etag(self.booking.id)
+        self.assertNotEqual(pending, etag)
+        on_commit.call_args[0][0]()
+        self.assertNotIn(booking_etag(self.booking.id), (etag, pending))
+
+    def test_my(self):
+        url = reverse('api-client:bookings-my')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        get_bookings(1, user=self.user)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_chat(self):
+        url = reverse('api-client:bookings-chat', kwargs={'pk': self.booking.id})
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        mommy.make(BookingChatRecord, booking=self.booking)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+# DETAIL CACHE
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DetailCacheTestCase(OnCommitMixin, ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+        self.url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+
+    def tearDown(self):
+        cache.clear()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_retrieve_uses_cached_payload(self):
+        data = self.client.get(self.url).json()
+        with mock.patch.object(BookingSerializer, 'to_representation', side_effect=AssertionError):
+            response = self.client.get(self.url)
+        self.assertEqual(response.json(), data)
+
+    def test_invalidation(self):
+        key = booking_detail_cache.key(self.booking)
+        self.booking.persons.first().save()
+        self.assertNotEqual(booking_detail_cache.key(self.booking), key)
+        key = booking_detail_cache.key(self.booking)
+        self.booking.course.save()
+        self.assertNotEqual(booking_detail_cache.key(self.booking), key)
+        key = booking_detail_cache.key(self.booking)
+        get_acm_price_range(accommodation=self.booking.accommodation, unit_price=50,
+                            weeks_count_from=33, weeks_count_to=40)
+        self.assertNotEqual(booking_detail_cache.key(self.booking), key)
+
+    def test_update_warms_cache_on_commit(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        with mock.patch.object(booking_detail_cache, 'warm') as warm, \
+                mock.patch.object(transaction, 'on_commit'):
+            self.client.patch(self.url, {'callback': False}, format='json')
+        self.assertFalse(warm.called)
+        self.run_on_commit()
+        response = self.client.patch(self.url, {'callback': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        with mock.patch.object(BookingSerializer, 'to_representation', side_effect=AssertionError):
+            self.assertEqual(self.client.get(self.url).json(), response.json())
+
+
+# PRICING
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PricingEngineTestCase(TestCase):
+    def setUp(self):
+        school = get_school(location=get_city(name="London"), languages=[get_language(name="English")])
+        self.course = get_course(type=get_course_type(name='Preparation to exam'), school=school)
+        get_course_price_range(course=self.course, unit_price=100, weeks_count_from=2, weeks_count_to=32)
+        self.accommodation = get_accommodation(type=get_accommodation_type(name='Homestay'), school=school)
+        get_acm_price_range(accommodation=self.accommodation, unit_price=50, weeks_count_from=2, weeks_count_to=32)
+
+    def tearDown(self):
+        cache.clear()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_quotes_are_memoised(self):
+        today = now()
+        expected = self.course.course_price(today, 2, 'RU')
+        self.assertEqual(pricing_engine.course_price(self.course, today, 2, 'RU'), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(pricing_engine.course_price(self.course, today, 2, 'RU'), expected)
+        expected = self.accommodation.acm_price(today.date(), 4)
+        self.assertEqual(pricing_engine.acm_price(self.accommodation, today.date(), 4), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(pricing_engine.acm_price(self.accommodation, today.date(), 4), expected)
+
+    def test_bound_items_quote_through_engine(self):
+        today = now()
+        expected = self.course.course_price(today, 2, 'RU')
+        pricing_engine.bind(self.course, self.accommodation)
+        self.assertEqual(self.course.course_price(today, 2, 'RU'), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.course.course_price(today, 2, 'RU'), expected)
+        self.accommodation.acm_price(today.date(), 4)
+        with self.assertNumQueries(0):
+            self.accommodation.acm_price(today.date(), 4)
+
+    def test_price_range_change_invalidates(self):
+        today = now()
+        before = pricing_engine.course_price(self.course, today, 2, 'RU')
+        price_range = get_course_price_range(course=self.course, unit_price=300, weeks_count_from=1,
+                                             weeks_count_to=3)
+        self.assertEqual(pricing_engine.course_price(self.course, today, 2, 'RU'),
+                         self.course.course_price(today, 2, 'RU'))
+        price_range.delete()
+        self.assertEqual(pricing_engine.course_price(self.course, today, 2, 'RU'), before)
+
+
+# BULK
+class BulkActionTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.bookings = get_bookings(3, user=self.user)
+        self.foreign = get_booking(user=get_student())
+        self.url = reverse('api-client:bookings-bulk')
+
+    def tearDown(self):
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_delete(self):
+        ids = [self.bookings[0].id, self.bookings[1].id, self.foreign.id]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {'ids': ids, 'operation': 'delete'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'id': self.bookings[0].id, 'result': 'ok'},
+            {'id': self.bookings[1].id, 'result': 'ok'},
+            {'id': self.foreign.id, 'result': 'not_found'},
+        ])
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(Booking.objects.filter(status=Booking.DELETED).count(), 2)
+        response = self.client.get(reverse('api-client:bookings-my'))
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def test_mark_viewed(self):
+        Booking.objects.filter(id__in=[booking.id for booking in self.bookings]).update(viewed=False)
+        response = self.client.post(self.url, {'ids': [self.bookings[0].id], 'operation': 'mark_viewed'},
+                                    format='json')
+        self.assertEqual(response.json()['results'], [{'id': self.bookings[0].id, 'result': 'ok'}])
+        self.assertEqual(Booking.objects.filter(viewed=False).count(), 2)
+
+    def test_status(self):
+        booking = self.bookings[0]
+        Booking.objects.filter(id=booking.id).update(status=Booking.WAITING_PAYMENT)
+        Booking.objects.filter(id=self.bookings[1].id).update(created_by=self.user)
+        response = self.client.post(self.url, {'ids': [booking.id, self.bookings[1].id], 'operation': 'status',
+                                               'status': Booking.WAITING_SCHOOL}, format='json')
+        self.assertEqual(response.json()['results'], [
+            {'id': booking.id, 'result': 'not_allowed'},
+            {'id': self.bookings[1].id, 'result': 'ok'},
+        ])
+        self.assertEqual(Booking.objects.get(id=self.bookings[1].id).status, Booking.WAITING_SCHOOL)
+        response = self.client.post(self.url, {'ids': [booking.id], 'operation': 'status'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_status_needs_client(self):
+        Booking.objects.filter(id=self.bookings[0].id).update(created_by=None)
+        response = self.client.post(self.url, {'ids': [self.bookings[0].id], 'operation': 'status',
+                                               'status': Booking.WAITING_SCHOOL}, format='json')
+        self.assertEqual(response.json()['results'], [{'id': self.bookings[0].id, 'result': 'not_allowed'}])
+        self.assertEqual(Booking.objects.get(id=self.bookings[0].id).status, self.bookings[0].status)
+
+
+# READ REPLICAS
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReplicaRoutingTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+        self.router = BookingReplicaRouter()
+
+    def tearDown(self):
+        cache.clear()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_router(self):
+        self.assertIsNone(self.router.db_for_read(Booking))
+        with read_from_replica('replica'):
+            self.assertEqual(self.router.db_for_read(Booking), 'replica')
+            self.assertIsNone(self.router.db_for_write(Booking))
+        self.assertIsNone(self.router.db_for_read(Booking))
+        with override_settings(BOOKING_READ_REPLICAS=['replica']):
+            self.assertFalse(self.router.allow_migrate('replica', 'bookings'))
+
+    @override_settings(BOOKING_READ_REPLICAS=['replica'])
+    def test_read_your_writes(self):
+        self.assertEqual(replica_for(self.user), 'replica')
+        url = reverse('api-client:bookings-bulk')
+        response = self.client.post(url, {'ids': [self.booking.id], 'operation': 'mark_viewed'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(replica_for(self.user))
+
+    def test_shared_caches_are_filled_from_primary(self):
+        seen = []
+
+        def my_not_viewed(user):
+            seen.append(current_replica())
+            return Booking.objects.none()
+
+        with mock.patch.object(Booking.objects, 'my_not_viewed', side_effect=my_not_viewed), \
+                read_from_replica('replica'):
+            not_viewed_counter.count(self.user)
+        self.assertEqual(seen, [None])
+
+    @override_settings(BOOKING_READ_REPLICAS=['default'])
+    def test_replica_bodies_are_not_tagged(self):
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        self.assertTrue(self.client.get(url).has_header('ETag'))
+        self.assertFalse(self.client.get(url, {'fields': 'id'}).has_header('ETag'))
+        url = reverse('api-client:bookings-chat', kwargs={'pk': self.booking.id})
+        self.assertFalse(self.client.get(url).has_header('ETag'))
+
+    @override_settings(BOOKING_READ_REPLICAS=['default'])
+    def test_read_actions_use_replica(self):
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        with mock.patch('api.client.bookings.views.start_reading_from') as start_reading_from:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        start_reading_from.assert_called_once_with('default')
+        self.assertIsNone(current_replica())
+
+
+# OBJECT LOADING
+class SingleObjectLoadTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+
+    def tearDown(self):
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def assertBookingLoadedOnce(self, method, url, **kwargs):
+        table = 'FROM "{}"'.format(Booking._meta.db_table)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([query for query in queries if table in query['sql']]), 1)
+
+    def test_chat(self):
+        self.assertBookingLoadedOnce('get', reverse('api-client:bookings-chat', kwargs={'pk': self.booking.id}))
+
+    def test_review(self):
+        self.assertBookingLoadedOnce('get', reverse('api-client:bookings-review', kwargs={'pk': self.booking.id}))
+
+    def test_delete(self):
+        self.assertBookingLoadedOnce('get', '/api/client/bookings/{}/delete/'.format(self.booking.id))
+        self.assertEqual(Booking.objects.get(pk=self.booking.id).status, Booking.DELETED)
+
+    def test_update(self):
+        self.booking.created_by = self.user
+        self.booking.save()
+        url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+        self.assertBookingLoadedOnce('patch', url, data={'callback': True}, format='json')
+
+
+# SPARSE FIELDSETS
+class SparseFieldsetsTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.bookings = get_bookings(3, user=self.user)
+
+    def tearDown(self):
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_retrieve_fields(self):
+        booking = self.bookings[0]
+        url = reverse('api-client:bookings-detail', kwargs={'pk': booking.id})
+        with mock.patch.object(BookingSerializer, 'get_rates_prices', side_effect=AssertionError):
+            response = self.client.get(url, {'fields': 'id,status,total_price'})
+        self.assertEqual(response.json(), {'id': booking.id, 'status': booking.status,
+                                           'total_price': booking.total_price})
+        response = self.client.get(url, {'fields': 'id', 'expand': 'persons'})
+        self.assertEqual(set(response.json()), {'id', 'persons'})
+        self.assertEqual(self.client.get(url, {'fields': 'id,nope'}).status_code, 400)
+
+    def test_compiled_list_matches_serializer(self):
+        url = reverse('api-client:bookings-my')
+        full = {item['id']: item for item in self.client.get(url).json()['results']}
+        fields = 'id,status,start_at,school_name,course_name,accommodation_name,extras_names'
+        with mock.patch('api.client.bookings.views.BookingListSerializer', side_effect=AssertionError):
+            response = self.client.get(url, {'fields': fields})
+        self.assertEqual(response.status_code, 200)
+        for item in response.json()['results']:
+            self.assertEqual(item, {name: full[item['id']][name] for name in fields.split(',')})
+
+
+    def test_list_expand(self):
+        url = reverse('api-client:bookings-my')
+        response = self.client.get(url, {'fields': 'id', 'expand': 'status'})
+        self.assertEqual(response.status_code, 200)
+        for item in response.json()['results']:
+            self.assertEqual(set(item), {'id', 'status'})
+        self.assertEqual(self.client.get(url, {'fields': 'id', 'expand': 'nope'}).status_code, 400)
+
+# EXPORT
+class ExportTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.bookings = get_bookings(5, user=self.user)
+        self.url = reverse('api-client:bookings-export')
+
+    def tearDown(self):
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    @override_settings(BOOKING_EXPORT_CHUNK_SIZE=2)
+    def test_ndjson(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(sorted(row['id'] for row in rows), sorted(booking.id for booking in self.bookings))
+        self.assertEqual(set(rows[0]), set(EXPORT_FIELDS))
+
+    def test_csv(self):
+        response = self.client.get(self.url, {'type': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(','), list(EXPORT_FIELDS))
+        self.assertEqual(len(lines), 6)
+
+    def test_unknown_type(self):
+        self.assertEqual(self.client.get(self.url, {'type': 'xml'}).status_code, 400)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   BOOKING_UPDATE_NOTIFICATION_WINDOW=60)
+class UpdateDebouncerTestCase(TestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def test_updates_are_coalesced(self):
+        key = 'bookings:notification-debounce:1:school@example.com:booking_updated'
+        with mock.patch.object(outbox, 'enqueue') as enqueue:
+            update_debouncer.merge(key, 'subject', 'school@example.com', 'booking_updated',
+                                   {'booking_id': 1}, ['callback'])
+            update_debouncer.merge(key, 'subject 2', 'school@example.com', 'booking_updated',
+                                   {'booking_id': 1}, ['persons', 'callback'])
+        self.assertEqual(enqueue.call_count, 1)
+        message = enqueue.call_args[0][0]
+        self.assertEqual(enqueue.call_args[1], {'delay': 60})
+        with mock.patch('api.client.bookings.notifications.send_email') as send_email:
+            self.assertEqual(outbox.deliver([message]), [])
+        send_email.assert_called_once_with(
+            'subject 2', 'school@example.com', 'booking_updated',
+            {'booking_id': 1, 'changes': ['callback', 'persons']})
+        self.assertIsNone(cache.get(key))
+
+    def test_steady_updates_do_not_postpone_the_mail(self):
+        key = 'bookings:notification-debounce:1:school@example.com:booking_updated'
+        start = 1000000.0
+        with mock.patch.object(outbox, 'enqueue') as enqueue:
+            for offset in range(0, 181, 30):
+                with mock.patch('api.client.bookings.notifications.time.time', return_value=start + offset):
+                    update_debouncer.merge(key, 'subject', 'school@example.com', 'booking_updated',
+                                           {'booking_id': 1}, ['callback'])
+        # The first mail was never claimed, so a second one is scheduled after two windows.
+        self.assertEqual(enqueue.call_count, 2)
+
+    def test_entry_is_gone_when_message_is_sent(self):
+        message = CoalescedMessage('bookings:notification-debounce:missing', 'school@example.com',
+                                   'booking_updated', 'subject', {'booking_id': 1, 'changes': ['callback']})
+        with mock.patch('api.client.bookings.notifications.send_email') as send_email:
+            outbox.deliver([message])
+        send_email.assert_called_once_with(
+            'subject', 'school@example.com', 'booking_updated', {'booking_id': 1, 'changes': ['callback']})
+        self.assertIsNone(message.key)
+
+    def test_claimed_entry_is_not_merged_again(self):
+        key = 'bookings:notification-debounce:1:school@example.com:booking_updated'
+        with mock.patch.object(outbox, 'enqueue') as enqueue:
+            update_debouncer.merge(key, 'subject', 'school@example.com', 'booking_updated',
+                                   {'booking_id': 1}, ['callback'])
+            message = enqueue.call_args[0][0]
+            self.assertTrue(message.prepare())
+            update_debouncer.merge(key, 'subject', 'school@example.com', 'booking_updated',
+                                   {'booking_id': 1}, ['persons'])
+        self.assertEqual(enqueue.call_count, 2)
+        self.assertEqual(message.ctx['changes'], ['callback'])
+        self.assertEqual(enqueue.call_args[0][0].ctx['changes'], ['persons'])
+
+
+# CONSTANCE CACHE
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class LocalConfigTestCase(TestCase):
+    def setUp(self):
+        local_config.clear()
+
+    def tearDown(self):
+        cache.clear()
+        local_config.clear()
+
+    @override_config(EMAIL_BOOKING_UPDATE_USER='Booking updated')
+    def test_values_are_cached(self):
+        self.assertEqual(local_config.get('EMAIL_BOOKING_UPDATE_USER'), 'Booking updated')
+        with mock.patch('api.client.bookings.config_cache.config') as config:
+            with self.assertNumQueries(0):
+                self.assertEqual(local_config.mget(['EMAIL_BOOKING_UPDATE_USER']),
+                                 {'EMAIL_BOOKING_UPDATE_USER': 'Booking updated'})
+        self.assertFalse(config._backend.mget.called)
+
+    def test_invalidation(self):
+        with override_config(EMAIL_BOOKING_UPDATE_USER='Old subject'):
+            self.assertEqual(local_config.get('EMAIL_BOOKING_UPDATE_USER'), 'Old subject')
+        with override_config(EMAIL_BOOKING_UPDATE_USER='New subject'):
+            invalidate_local_config()
+            self.assertEqual(local_config.get('EMAIL_BOOKING_UPDATE_USER'), 'New subject')
+
+    @override_config(EMAIL_BOOKING_UPDATE_USER='Booking updated')
+    def test_values_expire_without_change_signal(self):
+        local_config.get('EMAIL_BOOKING_UPDATE_USER')
+        with mock.patch('api.client.bookings.config_cache.config_updated', None):
+            local_config._refresh()
+            self.assertIn('EMAIL_BOOKING_UPDATE_USER', local_config._values)
+            local_config._expires_at = 0
+            local_config._refresh()
+        self.assertEqual(local_config._values, {})
+
+
+# CONCURRENCY
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class OptimisticConcurrencyTestCase(OnCommitMixin, ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.run_on_commit()
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+        self.booking.created_by = self.user
+        self.booking.save()
+        self.url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+
+    def tearDown(self):
+        cache.clear()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_if_match(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.patch(self.url, {'callback': True}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.patch(self.url, {'callback': False}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertTrue(Booking.objects.get(pk=self.booking.id).callback)
+
+    def test_chat_message_keeps_if_match(self):
+        etag = self.client.get(self.url)['ETag']
+        mommy.make(BookingChatRecord, booking=self.booking)
+        response = self.client.patch(self.url, {'callback': True}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_price_change_keeps_if_match(self):
+        etag = self.client.get(self.url)['ETag']
+        self.booking.course.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.patch(self.url, {'callback': True}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_concurrent_write_conflicts(self):
+        image = row_image(self.booking)
+        lock_if_unchanged(image)
+        Booking.objects.filter(pk=self.booking.id).update(callback=not self.booking.callback)
+        with self.assertRaises(Conflict):
+            lock_if_unchanged(image)
+
+    def test_write_between_read_and_save(self):
+        def concurrent_write(instance, validated_data):
+            Booking.objects.filter(pk=self.booking.id).update(viewed=not self.booking.viewed)
+            return BookingChanges(instance, validated_data)
+
+        with mock.patch('api.client.bookings.views.BookingChanges', side_effect=concurrent_write):
+            response = self.client.patch(self.url, {'callback': True}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+
+# INSTRUMENTATION
+@override_settings(BOOKING_METRICS_SAMPLE_RATE=1.0, BOOKING_METRICS_SINKS=(
+    'api.client.bookings.instrumentation.ServerTimingSink', 'api.client.bookings.instrumentation.RegistrySink'))
+class InstrumentationTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.booking = get_booking(user=self.user)
+        self.booking.created_by = self.user
+        self.booking.save()
+        self.url = reverse('api-client:bookings-detail', kwargs={'pk': self.booking.id})
+
+    def tearDown(self):
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def test_server_timing(self):
+        response = self.client.patch(self.url, {'callback': True}, format='json')
+        phases = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+        for phase in ('get_object', 'validate', 'save', 'email', 'serialize', 'total'):
+            self.assertIn(phase, phases)
+
+    def test_registry(self):
+        self.client.get(self.url)
+        rendered = registry.render()
+        self.assertIn('booking_api_requests_total{action="retrieve",method="GET",status="200"}', rendered)
+        self.assertIn('booking_api_sql_count_count{action="retrieve",method="GET"}', rendered)
+        self.assertIn('booking_api_payload_bytes_sum{action="retrieve",method="GET"}', rendered)
+
+    def test_queries_on_every_alias_are_counted(self):
+        default = mock.Mock(force_debug_cursor=False, queries_log=[{'time': '0.001'}])
+        replica = mock.Mock(force_debug_cursor=False, queries_log=[])
+        with mock.patch('api.client.bookings.instrumentation.connections') as connections:
+            connections.all.return_value = [default, replica]
+            metrics = ActionMetrics('retrieve', 'GET', [])
+        self.assertTrue(replica.force_debug_cursor)
+        default.queries_log.append({'time': '0.002'})
+        replica.queries_log.extend([{'time': '0.003'}, {'time': '0.004'}])
+        metrics.finish(HttpResponse())
+        self.assertEqual(metrics.counters['sql_count'], 3)
+        self.assertEqual(metrics.counters['sql_ms'], 9.0)
+        self.assertFalse(replica.force_debug_cursor)
+
+    @override_settings(BOOKING_METRICS_SAMPLE_RATE=0.0)
+    def test_not_sampled(self):
+        self.assertIs(start_metrics('retrieve', 'GET'), NULL_METRICS)
+        self.assertFalse(self.client.get(self.url).has_header('Server-Timing'))
+
+
+# ARCHIVE
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(BOOKING_ARCHIVE_ROOT=self.root, BOOKING_ARCHIVE_AFTER_DAYS=30)
+        self.settings.enable()
+        self.booking = get_booking()
+        mommy.make(BookingPerson, booking=self.booking, _quantity=2)
+        mommy.make(BookingChatRecord, booking=self.booking, _quantity=3)
+        Booking.objects.filter(pk=self.booking.id).update(status=Booking.DELETED)
+        self.mark_deleted(days=31)
+
+    def tearDown(self):
+        self.settings.disable()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+
+    def mark_deleted(self, days):
+        name = 'booking-archive/deleted.json'
+        if archive_storage().exists(name):
+            archive_storage().delete(name)
+        ledger = {str(self.booking.id): (now() - timedelta(days=days)).isoformat()}
+        archive_storage().save(name, ContentFile(json.dumps(ledger).encode()))
+
+    def test_archive_and_restore(self):
+        self.assertEqual(archive_deleted_bookings(batch_size=1), [self.booking.id])
+        self.assertFalse(Booking.objects.filter(pk=self.booking.id).exists())
+        self.assertFalse(BookingPerson.objects.filter(booking_id=self.booking.id).exists())
+        self.assertTrue(archive_storage().exists('booking-archive/{}.json'.format(self.booking.id)))
+
+        booking = restore_booking(self.booking.id)
+        self.assertEqual(booking.status, Booking.DELETED)
+        self.assertEqual(BookingPerson.objects.filter(booking=booking).count(), 2)
+        self.assertEqual(BookingChatRecord.objects.filter(booking=booking).count(), 3)
+        self.assertFalse(archive_storage().exists('booking-archive/{}.json'.format(self.booking.id)))
+
+    def test_threshold(self):
+        Booking.objects.filter(pk=self.booking.id).update(created_at=now() - timedelta(days=100))
+        self.mark_deleted(days=29)
+        live = get_booking()
+        self.assertEqual(archive_deleted_bookings(), [])
+        self.assertEqual(Booking.objects.filter(pk__in=[self.booking.id, live.id]).count(), 2)
+
+    def test_newly_deleted_bookings_start_the_clock(self):
+        archive_storage().delete('booking-archive/deleted.json')
+        Booking.objects.filter(pk=self.booking.id).update(created_at=now() - timedelta(days=100))
+        self.assertEqual(archive_deleted_bookings(), [])
+        self.assertLess(now() - deleted_since()[self.booking.id], timedelta(minutes=1))
+
+    def test_failing_booking_is_skipped(self):
+        other = get_booking()
+        Booking.objects.filter(pk=other.id).update(status=Booking.DELETED)
+        ledger = {str(pk): (now() - timedelta(days=31)).isoformat() for pk in (self.booking.id, other.id)}
+        archive_storage().delete('booking-archive/deleted.json')
+        archive_storage().save('booking-archive/deleted.json', ContentFile(json.dumps(ledger).encode()))
+        original = Booking.delete
+
+        def delete(booking, *args, **kwargs):
+            if booking.pk == self.booking.id:
+                raise DatabaseError('protected')
+            return original(booking, *args, **kwargs)
+
+        with mock.patch.object(Booking, 'delete', delete):
+            self.assertEqual(archive_deleted_bookings(), [other.id])
+        self.assertTrue(Booking.objects.filter(pk=self.booking.id).exists())
+        self.assertFalse(archive_storage().exists('booking-archive/{}.json'.format(self.booking.id)))
+
+    def test_restore_skips_dropped_fields(self):
+        archive_deleted_bookings()
+        name = 'booking-archive/{}.json'.format(self.booking.id)
+        with archive_storage().open(name) as archive:
+            document = json.loads(archive.read().decode())
+        self.assertIn('bookings', document['schema'])
+        for obj in document['objects']:
+            obj['fields']['dropped_column'] = 1
+        archive_storage().delete(name)
+        archive_storage().save(name, ContentFile(json.dumps(document).encode()))
+        self.assertEqual(restore_booking(self.booking.id).pk, self.booking.id)
+
+
+# UPLOADS
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class UploadsTestCase(ApiStudentLoginMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_and_login()
+        self.url = reverse('api-client:bookings-uploads')
+
+    def tearDown(self):
+        for uploaded in UploadedFile.objects.all():
+            uploaded.file.delete(save=False)
+        UploadedFile.objects.all().delete()
+        Booking.objects.all().delete()
+        Language.objects.all().delete()
+        Currency.objects.all().delete()
+        cache.clear()
+
+    def put(self, token, body):
+        return self.client.put('{}?token={}'.format(self.url, token), body, content_type='application/octet-stream')
+
+    def test_streamed_upload(self):
+        token = self.client.post(self.url, {'name': 'passport.jpg'}, format='json').json()['token']
+        with open('fixtures/panda.jpg', 'rb') as image:
+            body = image.read()
+        with override_settings(BOOKING_UPLOAD_CHUNK_SIZE=1024):
+            response = self.put(token, body)
+        self.assertEqual(response.status_code, 201)
+        uploaded = UploadedFile.objects.get(pk=response.json()['id'])
+        self.assertEqual(uploaded.created_by, self.user)
+        self.assertEqual(uploaded.file.read(), body)
+
+    def test_invalid_token(self):
+        self.assertEqual(self.put('forged', b'data').status_code, 403)
+        other = get_student()
+        self.assertEqual(self.put(upload_token(other, 'a.jpg'), b'data').status_code, 403)
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_token_is_single_use(self):
+        token = upload_token(self.user, 'a.jpg')
+        self.assertEqual(self.put(token, b'data').status_code, 201)
+        self.assertEqual(self.put(token, b'data').status_code, 403)
+        self.assertEqual(UploadedFile.objects.count(), 1)
+
+    def review_payload(self, booking):
+        review = mommy.make(BookingReview, booking=booking)
+        data = BookingReviewSerializer(review, context={'request': None}).data
+        review.delete()
+        data.pop('id', None)
+        return data
+
+    def test_review_attachments_are_upload_ids(self):
+        booking = get_booking(user=self.user)
+        url = reverse('api-client:bookings-review', kwargs={'pk': booking.id})
+        other = UploadedFile.objects.create(created_by=get_student(), file=ContentFile(b'data', 'a.jpg'))
+        response = self.client.post(url, {'attachments': [other.id]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('attachments', response.json())
+        self.assertFalse(BookingReview.objects.filter(booking=booking).exists())
+
+    def test_review_with_attachment(self):
+        booking = get_booking(user=self.user)
+        url = reverse('api-client:bookings-review', kwargs={'pk': booking.id})
+        uploaded = UploadedFile.objects.create(created_by=self.user, file=ContentFile(b'data', 'a.jpg'))
+        data = dict(self.review_payload(booking), attachments=[uploaded.id])
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(BookingReview.objects.filter(booking=booking).exists())
+        # The review links the stored file instead of a copy of it.
+        self.assertEqual(UploadedFile.objects.count(), 1)
+        self.assertEqual(uploaded.file.read(), b'data')
+
+    def test_multipart_review_is_still_accepted(self):
+        booking = get_booking(user=self.user)
+        url = reverse('api-client:bookings-review', kwargs={'pk': booking.id})
+        response = self.client.post(url, {'data': json.dumps(self.review_payload(booking))}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(BookingReview.objects.filter(booking=booking).exists())
+
+    @override_settings(BOOKING_UPLOAD_MAX_SIZE=3)
+    def test_too_large(self):
+        self.assertEqual(self.put(upload_token(self.user, 'a.jpg'), b'data').status_code, 413)
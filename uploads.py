@@ -0,0 +1,156 @@
+"""
+Uploads that are streamed straight to storage.
+
+A client first asks for a signed upload token naming its file, then ``PUT``s
+the raw file body with that token. ``store_upload`` copies the request
+stream to the storage of ``UploadedFile.file`` in
+``BOOKING_UPLOAD_CHUNK_SIZE`` chunks, so a worker never holds more than one
+chunk of the file, and creates the ``UploadedFile`` row. Persons then only
+reference the stored file by its URL and reviews by the ``UploadedFile`` id
+(see ``uploaded_files`` and ``attach_uploads``).
+
+The token is bound to the user, expires after ``BOOKING_UPLOAD_TOKEN_TTL``
+seconds and can be used once, so a storage backend accepting direct uploads
+can verify it the same way as the local ``uploads`` action does.
+"""
+import os
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.db.models import FileField
+from django.utils.text import get_valid_filename
+from rest_framework import status
+from rest_framework.exceptions import APIException, PermissionDenied, ValidationError
+
+from core.models import UploadedFile
+
+TOKEN_SALT = 'api.client.bookings.uploads'
+USED_TOKEN_KEY = 'bookings:upload-token:{}'
+
+
+class LengthRequired(APIException):
+    status_code = status.HTTP_411_LENGTH_REQUIRED
+    default_detail = 'Uploads need a Content-Length.'
+    default_code = 'length_required'
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'The upload is too large.'
+    default_code = 'upload_too_large'
+
+
+class StreamFile(File):
+    """
+    A ``File`` over a non-seekable stream of known size, read in chunks.
+    """
+
+    def __init__(self, stream, name, size):
+        super(StreamFile, self).__init__(stream, name)
+        self.size = size
+
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or getattr(settings, 'BOOKING_UPLOAD_CHUNK_SIZE', self.DEFAULT_CHUNK_SIZE)
+        remaining = self.size
+        while remaining > 0:
+            chunk = self.file.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ValidationError('The upload ended before Content-Length bytes were sent.')
+            remaining -= len(chunk)
+            yield chunk
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+
+def upload_token(user, filename):
+    name = get_valid_filename(os.path.basename(filename or ''))
+    if not name:
+        raise ValidationError({'name': 'A file name is required.'})
+    return signing.dumps({'user': user.pk, 'name': name, 'nonce': uuid.uuid4().hex}, salt=TOKEN_SALT)
+
+
+def read_upload_token(token, user):
+    """
+    Return the file name of ``token`` and mark the token as used.
+    """
+    ttl = getattr(settings, 'BOOKING_UPLOAD_TOKEN_TTL', 3600)
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT, max_age=ttl)
+    except signing.BadSignature:
+        raise PermissionDenied('Invalid or expired upload token.')
+    if payload['user'] != user.pk or 'nonce' not in payload:
+        raise PermissionDenied('Invalid or expired upload token.')
+    # The mark only has to outlive the token itself.
+    if not cache.add(USED_TOKEN_KEY.format(payload['nonce']), 1, ttl):
+        raise PermissionDenied('The upload token has already been used.')
+    return payload['name']
+
+
+def uploaded_files(ids, user):
+    """
+    Return the ``UploadedFile`` rows for ``ids``, which all have to be
+    uploaded by ``user``.
+    """
+    if not isinstance(ids, list):
+        raise ValidationError({'attachments': 'A list of upload ids is expected.'})
+    try:
+        ids = [int(pk) for pk in ids]
+    except (TypeError, ValueError):
+        raise ValidationError({'attachments': 'A list of upload ids is expected.'})
+    files = UploadedFile.objects.filter(created_by=user).in_bulk(ids)
+    missing = [pk for pk in ids if pk not in files]
+    if missing:
+        raise ValidationError({'attachments': 'Unknown uploads: {}.'.format(', '.join(map(str, missing)))})
+    return [files[pk] for pk in ids]
+
+
+def store_upload(request, token):
+    filename = read_upload_token(token, request.user)
+    try:
+        size = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        raise LengthRequired()
+    if size > getattr(settings, 'BOOKING_UPLOAD_MAX_SIZE', 20 * 1024 * 1024):
+        raise UploadTooLarge()
+
+    field = UploadedFile._meta.get_field('file')
+    uploaded = UploadedFile(created_by=request.user)
+    name = field.storage.save(field.generate_filename(uploaded, filename), StreamFile(request.stream, filename, size))
+    uploaded.file = name
+    uploaded.save()
+    uploaded.update_url()
+    return uploaded
+
+
+def attach_uploads(instance, uploads):
+    """
+    Link stored ``uploads`` to ``instance``, either through its relation to
+    ``UploadedFile`` or through a model related to it that holds a file.
+    Only the storage name is copied, never the file bytes.
+    """
+    for field in instance._meta.get_fields():
+        if field.many_to_many and field.related_model is UploadedFile:
+            accessor = field.get_accessor_name() if field.auto_created else field.name
+            getattr(instance, accessor).add(*uploads)
+            return
+    for relation in instance._meta.related_objects:
+        if not relation.one_to_many:
+            continue
+        model = relation.related_model
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.related_model is UploadedFile:
+                for upload in uploads:
+                    model.objects.create(**{relation.field.name: instance, field.name: upload})
+                return
+            if isinstance(field, FileField):
+                for upload in uploads:
+                    model.objects.create(**{relation.field.name: instance, field.name: upload.file.name})
+                return
+    raise ImproperlyConfigured('{} has no relation to store uploads in.'.format(instance._meta.label))
@@ -0,0 +1,169 @@
+"""
+Cheap version tokens for bookings.
+
+Every save or delete of a booking, its persons or extras replaces the
+booking's token in the cache, right away and again once the transaction
+commits: a reader that saw the old rows in between can only have paired
+them with a token that is already gone. Chat records and reviews replace
+a separate activity token, so a new chat message does not invalidate the
+ETag a client sends in ``If-Match`` with its next autosave. Views compare
+ETags built from these tokens with ``If-None-Match`` before doing any
+serialization work.
+
+Courses and accommodations have pricing tokens of their own, replaced when
+the item or one of its price ranges changes, so cached booking payloads
+that contain prices can key on them.
+"""
+import hashlib
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.http import parse_etags, quote_etag
+
+from bookings.models import Booking, BookingChatRecord, BookingPerson, BookingReview, BookingsExtra
+from schools.models import Accommodation, AccommodationPriceRange, Course, CoursePriceRange
+
+CACHE_KEY = 'bookings:version:{}'
+ACTIVITY_CACHE_KEY = 'bookings:activity:{}'
+PRICING_CACHE_KEY = 'bookings:pricing:{}:{}'
+
+
+def _versions(keys):
+    cached = cache.get_many(keys)
+    missing = {key: uuid.uuid4().hex for key in keys if key not in cached}
+    if missing:
+        cache.set_many(missing, None)
+        cached.update(missing)
+    return cached
+
+
+def booking_versions(booking_ids, key=CACHE_KEY):
+    versions = _versions([key.format(booking_id) for booking_id in booking_ids])
+    return {booking_id: versions[key.format(booking_id)] for booking_id in booking_ids}
+
+
+def booking_version(booking_id, key=CACHE_KEY):
+    return booking_versions([booking_id], key)[booking_id]
+
+
+def _replace_booking_versions(booking_ids, key):
+    cache.set_many({key.format(booking_id): uuid.uuid4().hex for booking_id in booking_ids}, None)
+
+
+def bump_booking_versions(*booking_ids, key=CACHE_KEY):
+    _replace_booking_versions(booking_ids, key)
+    transaction.on_commit(lambda: _replace_booking_versions(booking_ids, key))
+
+
+def bump_activity_versions(*booking_ids):
+    bump_booking_versions(*booking_ids, key=ACTIVITY_CACHE_KEY)
+
+
+def pricing_versions(items):
+    """
+    Return the pricing tokens of ``items``, a list of ``(kind, id)`` pairs
+    where kind is ``'course'`` or ``'accommodation'``.
+    """
+    keys = {item: PRICING_CACHE_KEY.format(*item) for item in items}
+    cached = _versions(list(keys.values()))
+    return [cached[keys[item]] for item in items]
+
+
+def _replace_pricing_version(key):
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def bump_pricing_version(kind, item_id):
+    key = PRICING_CACHE_KEY.format(kind, item_id)
+    _replace_pricing_version(key)
+    transaction.on_commit(lambda: _replace_pricing_version(key))
+
+
+def detail_versions(booking):
+    """
+    Return the booking token and the pricing tokens of its course and
+    accommodation, everything the full booking payload depends on.
+    """
+    course_version, accommodation_version = pricing_versions(
+        [('course', booking.course_id), ('accommodation', booking.accommodation_id)])
+    return booking_version(booking.id), course_version, accommodation_version
+
+
+def booking_etag(booking_id):
+    """
+    ETag of the booking row, its persons and extras.
+    """
+    return quote_etag('{}-{}'.format(booking_id, booking_version(booking_id)))
+
+
+def detail_etag(booking):
+    """
+    ETag of the full booking payload. It starts with ``booking_etag`` so it
+    can be sent back in ``If-Match``; a price change only makes it stale
+    for ``If-None-Match``.
+    """
+    return quote_etag('{}-{}-{}-{}'.format(booking.id, *detail_versions(booking)))
+
+
+def activity_etag(booking_id):
+    """
+    ETag of the booking together with its chat records and reviews.
+    """
+    versions = _versions([CACHE_KEY.format(booking_id), ACTIVITY_CACHE_KEY.format(booking_id)])
+    return quote_etag('{}-{}-{}'.format(
+        booking_id, versions[CACHE_KEY.format(booking_id)], versions[ACTIVITY_CACHE_KEY.format(booking_id)]))
+
+
+def collection_etag(booking_ids):
+    versions = _versions([key.format(booking_id) for booking_id in booking_ids
+                          for key in (CACHE_KEY, ACTIVITY_CACHE_KEY)])
+    digest = hashlib.md5()
+    for booking_id in booking_ids:
+        digest.update('{}-{}-{};'.format(
+            booking_id, versions[CACHE_KEY.format(booking_id)],
+            versions[ACTIVITY_CACHE_KEY.format(booking_id)]).encode())
+    return quote_etag(digest.hexdigest())
+
+
+def etag_matches(request, etag):
+    return etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+
+@receiver([post_save, post_delete], sender=Booking)
+def bump_booking(sender, instance, **kwargs):
+    bump_booking_versions(instance.id)
+
+
+@receiver([post_save, post_delete], sender=BookingPerson)
+@receiver([post_save, post_delete], sender=BookingsExtra)
+def bump_related(sender, instance, **kwargs):
+    bump_booking_versions(instance.booking_id)
+
+
+@receiver([post_save, post_delete], sender=BookingChatRecord)
+@receiver([post_save, post_delete], sender=BookingReview)
+def bump_activity(sender, instance, **kwargs):
+    bump_activity_versions(instance.booking_id)
+
+
+@receiver([post_save, post_delete], sender=Course)
+def bump_course_pricing(sender, instance, **kwargs):
+    bump_pricing_version('course', instance.id)
+
+
+@receiver([post_save, post_delete], sender=Accommodation)
+def bump_accommodation_pricing(sender, instance, **kwargs):
+    bump_pricing_version('accommodation', instance.id)
+
+
+@receiver([post_save, post_delete], sender=CoursePriceRange)
+def bump_course_price_range_pricing(sender, instance, **kwargs):
+    bump_pricing_version('course', instance.course_id)
+
+
+@receiver([post_save, post_delete], sender=AccommodationPriceRange)
+def bump_accommodation_price_range_pricing(sender, instance, **kwargs):
+    bump_pricing_version('accommodation', instance.accommodation_id)
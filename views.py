@@ -2,6 +2,8 @@ import logging
 import json
 
 from django.conf import settings
+from django.db import router, transaction
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from rest_framework.exceptions import MethodNotAllowed, NotFound, \
     ValidationError
@@ -9,14 +11,28 @@ from rest_framework.decorators import list_route, detail_route
 from rest_framework.viewsets import mixins
 from rest_framework.response import Response
 from rest_framework import viewsets, status
-from rest_framework.permissions import AllowAny, IsAuthenticated
-
-from constance import config
+from rest_framework.permissions import AllowAny, IsAuthenticated, SAFE_METHODS
 
 from bookings.models import Booking
 from .serializers import BookingSerializer, BookingListSerializer, BookingChatRecordSerializer, BookingReviewSerializer
 from bookings.permissions import HasBookingClientAccess
-from common.utils import send_email
+from .bulk import BookingBulkActionSerializer, BulkBookingAction
+from .changes import BookingChanges
+from .chat import parse_wait, records_after, wait_for_records
+from .concurrency import check_if_match, lock_if_unchanged, row_image
+from .counters import not_viewed_counter
+from .detail_cache import booking_detail_cache
+from .export import CONTENT_TYPES, EXPORTERS
+from .fieldsets import apply_fieldsets, compilable, compiled_list_rows, requested, requested_fields
+from .instrumentation import NULL_METRICS, start_metrics
+from .nested import NESTED_SETS, NestedPatch
+from .notifications import BookingNotifications
+from .pagination import BookingCursorPagination
+from .pricing import pricing_engine
+from .routers import current_replica, pin_to_primary, read_from_replica, replica_for, start_reading_from, \
+    stop_reading_from_replica
+from .uploads import attach_uploads, store_upload, upload_token, uploaded_files
+from .versions import activity_etag, bump_booking_versions, collection_etag, detail_etag, etag_matches
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +44,48 @@ class BookingViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.Re
     serializer_class = BookingSerializer
     queryset = Booking.objects.all()
 
+    read_actions = ('retrieve', 'my', 'my_not_viewed_count', 'chat', 'review')
+    # Relations HasBookingClientAccess looks at.
+    access_related = ('user', 'created_by')
+    # Relations each detail action reads, loaded together with the access check.
+    action_related = {
+        'retrieve': access_related + ('course__school', 'course__type', 'accommodation__type'),
+        'update': access_related + BookingNotifications.related + ('accommodation__type', ),
+        'partial_update': access_related + BookingNotifications.related + ('accommodation__type', ),
+    }
+
+    def get_queryset(self):
+        queryset = super(BookingViewSet, self).get_queryset()
+        return queryset.select_related(*self.action_related.get(self.action, self.access_related))
+
+    def get_object(self):
+        # Every detail action loads its booking once, with what it needs.
+        if not hasattr(self, '_booking'):
+            with self.metrics.phase('get_object'):
+                self._booking = super(BookingViewSet, self).get_object()
+        return self._booking
+
+    metrics = NULL_METRICS
+
+    def initial(self, request, *args, **kwargs):
+        self.metrics = start_metrics(self.action, request.method)
+        super(BookingViewSet, self).initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and self.action in self.read_actions:
+            start_reading_from(replica_for(request.user))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        stop_reading_from_replica()
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(request.user)
+        response = super(BookingViewSet, self).finalize_response(request, response, *args, **kwargs)
+        self.metrics.finish(response)
+        return response
+
+    def perform_create(self, serializer):
+        self._quote_through_engine(serializer)
+        serializer.save()
+
+    @transaction.atomic
     def update(self, request, *args, **kwargs):
         new_user = False
         data = request.data
@@ -35,11 +93,31 @@ class BookingViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.Re
         partial = kwargs.pop('partial', False)
         instance = self.get_object()
         old_status = instance.status
+        check_if_match(request, instance.id)
+        image = row_image(instance)
         if not instance.created_by:
             new_user = True
+        patches = []
+        if partial and any(name in data or '{}_removed'.format(name) in data for name in NESTED_SETS):
+            data = data.copy()
+            patches = [patch.apply() for patch in NestedPatch.from_data(instance, data, self.get_serializer())]
         serializer = self.get_serializer(instance, data=data, partial=partial)
-        serializer.is_valid(raise_exception=True)
-        booking = serializer.save()
+        with self.metrics.phase('validate'):
+            serializer.is_valid(raise_exception=True)
+        changes = BookingChanges(instance, serializer.validated_data)
+        if any(patch.changed for patch in patches):
+            bump_booking_versions(instance.id)
+        if any(patch.pricing_changed for patch in patches):
+            changes.pricing = True
+            serializer.validated_data['person_count'] = instance.persons.count()
+        with self.metrics.phase('save'):
+            if changes.column_only:
+                # The conditional UPDATE is the concurrency check; no extra lock query.
+                booking = changes.apply(image)
+            else:
+                lock_if_unchanged(image)
+                self._quote_through_engine(serializer, instance)
+                booking = serializer.save()
         if getattr(instance, '_prefetched_objects_cache', None):
             # If 'prefetch_related' has been applied to a queryset, we need to
             # forcibly invalidate the prefetch cache on the instance.
@@ -47,49 +125,111 @@ class BookingViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.Re
 
         serializer = BookingSerializer(instance, context={'request': self.request, 'new_user': new_user})
         new_status = booking.status
-        if old_status == Booking.NEW and new_status == Booking.WAITING_SCHOOL and booking.created_by:
-            self._send_booking_notification_emails(
-                subject=config.EMAIL_BOOKING_CREATE_CLIENT_CONFIRM, booking_id=booking.id,
-                is_user=False, is_created_by=True, update=False)
-
-            self._send_booking_notification_emails(
-                subject=config.EMAIL_BOOKING_CREATE_USER, booking_id=booking.id,
-                is_user=True, is_created_by=False, update=False)
-        else:
-            self._send_booking_notification_emails(
-                subject=config.EMAIL_BOOKING_UPDATE_USER, booking_id=booking.id,
-                is_user=True, is_created_by=False, update=True)
-        return Response(serializer.data)
+        created = bool(old_status == Booking.NEW and new_status == Booking.WAITING_SCHOOL and booking.created_by)
+        changed = list(changes.fields) + [patch.name for patch in patches if patch.changed] + changes.nested
+        with self.metrics.phase('email'):
+            self._send_booking_notification_emails(booking, created=created, changes=changed)
+        with self.metrics.phase('serialize'):
+            data = serializer.data
+        response = Response(data)
+
+        def after_commit():
+            # The version has been replaced for the committed rows by now.
+            if not new_user:
+                booking_detail_cache.warm(instance, data)
+            response['ETag'] = detail_etag(booking)
+
+        transaction.on_commit(after_commit)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        sparse = requested(request, 'fields') is not None
+
+        def respond():
+            with self.metrics.phase('serialize'):
+                if sparse:
+                    return Response(apply_fieldsets(self.get_serializer(instance), request).data)
+                return Response(booking_detail_cache.get_or_build(instance, lambda: self._primary_data(instance)))
+
+        # The full payload always comes from the primary-built detail cache.
+        return self._conditional_response(detail_etag(instance), respond, consistent=not sparse)
 
     @list_route(['get'])
     def my(self, request):
-        serializer = BookingListSerializer(
-            Booking.objects.my_frontend(request.user).exclude(status=Booking.DELETED).order_by('-created_at'),
-            many=True,
-            context={'request': self.request}
-        )
-        return Response(serializer.data)
+        queryset = Booking.objects.my_frontend(request.user).exclude(status=Booking.DELETED)
+        paginator = BookingCursorPagination()
+        page_ids = [booking.id for booking in paginator.paginate_queryset(
+            queryset.only('id', 'created_at'), request, view=self)]
+
+        def respond():
+            # Names outside the compiled columns, unknown ones included, go to apply_fieldsets.
+            fields = requested_fields(request)
+            if compilable(fields):
+                return paginator.get_paginated_response(compiled_list_rows(queryset, page_ids, fields))
+            bookings = queryset.filter(id__in=page_ids).select_related(
+                'course__school', 'course__type', 'accommodation__type').prefetch_related('bookingsextra_set__extra')
+            position = {booking_id: index for index, booking_id in enumerate(page_ids)}
+            bookings = sorted(bookings, key=lambda booking: position[booking.id])
+            serializer = apply_fieldsets(
+                BookingListSerializer(bookings, many=True, context={'request': self.request}), request)
+            return paginator.get_paginated_response(serializer.data)
+
+        return self._conditional_response(collection_etag(page_ids), respond)
+
+    @list_route(['get'])
+    def export(self, request):
+        kind = request.query_params.get('type', 'ndjson')
+        if kind not in EXPORTERS:
+            raise ValidationError({'type': 'Expected one of: {}.'.format(', '.join(sorted(EXPORTERS)))})
+        queryset = Booking.objects.my_frontend(request.user).exclude(status=Booking.DELETED)
+        response = StreamingHttpResponse(EXPORTERS[kind](queryset), content_type=CONTENT_TYPES[kind])
+        response['Content-Disposition'] = 'attachment; filename="bookings.{}"'.format(kind)
+        return response
 
     @list_route(['get'])
     def my_not_viewed_count(self, request):
-        not_viewed = Booking.objects.my_not_viewed(request.user).count()
-        return Response({'not_viewed_count': not_viewed})
+        return Response({'not_viewed_count': not_viewed_counter.get(request.user)})
 
     @list_route(['post'])
     def my_set_viewed(self, request):
-        Booking.objects.my_not_viewed(request.user).update(viewed=True)
+        not_viewed = Booking.objects.my_not_viewed(request.user)
+        booking_ids = list(not_viewed.values_list('id', flat=True))
+        not_viewed.filter(id__in=booking_ids).update(viewed=True)
+        bump_booking_versions(*booking_ids)
+        not_viewed_counter.reset(request.user)
         return Response({'not_viewed_count': 0})
 
+    @list_route(['post'])
+    def bulk(self, request):
+        serializer = BookingBulkActionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = BulkBookingAction(
+            request.user, context=self.get_serializer_context(), **serializer.validated_data).run()
+        return Response({'results': results})
+
+    @list_route(['post', 'put'])
+    def uploads(self, request):
+        if request.method.upper() == 'POST':
+            return Response({'token': upload_token(request.user, request.data.get('name'))})
+        # The raw body is copied to storage chunk by chunk; request.data must not be touched here.
+        uploaded = store_upload(request, request.query_params.get('token', ''))
+        return Response({'id': uploaded.id, 'url': uploaded.file.url}, status=status.HTTP_201_CREATED)
+
     @detail_route(['post', 'get'])
     def chat(self, request, pk):
         booking = self.get_object()
         if request.method.upper() == 'GET':
-            serializer = BookingChatRecordSerializer(
-                booking.chat_records.all(),
-                many=True,
-                context={'request': self.request}
-            )
-            return Response(serializer.data)
+            records = booking.chat_records.all()
+            after = request.query_params.get('after')
+            if after:
+                records = records_after(records, after)
+            wait = request.query_params.get('wait')
+            if wait:
+                records = wait_for_records(records, booking.id, parse_wait(wait))
+                return Response(self._chat_data(records))
+            return self._conditional_response(
+                activity_etag(booking.id), lambda: Response(self._chat_data(records)))
         else:
             serializer = BookingChatRecordSerializer(
                 data=request.data,
@@ -103,20 +243,32 @@ class BookingViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.Re
     def review(self, request, pk):
         booking = self.get_object()
         if request.method.upper() == 'GET':
-            serializer = BookingReviewSerializer(
-                booking.reviews.all(),
-                many=True,
-                context={'request': self.request}
-            )
-            return Response(serializer.data)
+            def respond():
+                serializer = BookingReviewSerializer(
+                    booking.reviews.all(),
+                    many=True,
+                    context={'request': self.request}
+                )
+                return Response(serializer.data)
+
+            return self._conditional_response(activity_etag(booking.id), respond)
         else:
-            data = json.loads(request.data.get('data'))
+            data = request.data
+            if isinstance(data.get('data'), str):
+                # Multipart form carrying the review as a JSON string, still sent by older clients.
+                data = json.loads(data['data'])
+            # Attachments are streamed through ``uploads`` first and referenced by id.
+            data = dict(data)
+            attachments = uploaded_files(data.pop('attachments', []), request.user)
             serializer = BookingReviewSerializer(
                 data=data,
                 context={'request': self.request, 'booking': booking}
             )
             serializer.is_valid(raise_exception=True)
-            serializer.save()
+            with transaction.atomic():
+                review = serializer.save()
+                if attachments:
+                    attach_uploads(review, attachments)
             return Response(serializer.data)
 
     @detail_route(['get'])
@@ -125,24 +277,40 @@ class BookingViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.Re
         if not booking:
             return Response(status=status.HTTP_400_BAD_REQUEST, data={'error': 'no booking with given id'})
         booking.status = Booking.DELETED
-        booking.save()
+        booking.save(update_fields=['status'])
         return Response(status=status.HTTP_200_OK, data={'message': 'success'})
 
-    def _send_booking_notification_emails(self, subject, booking_id, is_user, is_created_by, update):
-        booking = Booking.objects.filter(
-            id=booking_id).select_related('course__school', 'course__type', 'created_by', 'user').first()
-        if is_created_by and not update:
-            ctx = dict(school=booking.course.school.name, course=booking.course.type.name)
-            send_email(subject, booking.created_by.email, 'booking_confirm', ctx)
-        if is_user and not update:
-            ctx = dict(
-                school=booking.course.school.name, course=booking.course.type.name,
-                user_first_name=booking.created_by.first_name, user_last_name=booking.created_by.last_name,
-                user_email=booking.created_by.email)
-            send_email(subject, booking.school.created_by.email, 'booking_created', ctx)
-        if is_user and update:
-            ctx = dict(
-                school=booking.course.school.name, course=booking.course.type.name,
-                user_first_name=booking.created_by.first_name, user_last_name=booking.created_by.last_name,
-                user_email=booking.created_by.email, booking_id=booking.id)
-            send_email(subject, booking.school.created_by.email, 'booking_updated', ctx)
+    def _chat_data(self, records):
+        return BookingChatRecordSerializer(records, many=True, context={'request': self.request}).data
+
+    def _conditional_response(self, etag, respond, consistent=False):
+        """
+        ``consistent`` tells that ``respond`` does not read from a replica,
+        whose rows may predate ``etag``; replica-built bodies go out without
+        the tag, so clients never keep them as the current version.
+        """
+        if etag_matches(self.request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            reading_replica = current_replica() is not None
+            response = respond()
+            if reading_replica and not consistent:
+                return response
+        response['ETag'] = etag
+        return response
+
+    def _primary_data(self, booking):
+        # Payloads go into the shared detail cache, so build them from the primary.
+        with read_from_replica(None):
+            if booking._state.db != router.db_for_write(Booking):
+                booking = self.get_queryset().get(pk=booking.pk)
+            return self.get_serializer(booking).data
+
+    def _quote_through_engine(self, serializer, instance=None):
+        items = [serializer.validated_data.get('course'), serializer.validated_data.get('accommodation')]
+        if instance is not None:
+            items += [instance.course, instance.accommodation]
+        pricing_engine.bind(*items)
+
+    def _send_booking_notification_emails(self, booking, created, changes=()):
+        BookingNotifications(booking).send(created, changes)